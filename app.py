@@ -1,14 +1,21 @@
 # Import software dependencies
 import os
-from flask import redirect, request
-from dash import Dash, html, page_container
-import logging
-from utils import get_smart, app_settings, reset
 from dotenv import load_dotenv
 
-# Load environment variables from .env file
+# Load environment variables from .env file, before the app's modules read their configuration
 load_dotenv()
 
+from flask import redirect, request, session, g, Response, abort
+from dash import Dash, html, page_container
+import logging
+import uuid
+import time
+import random
+import threading
+from utils import get_smart, get_session_id, reset
+from prefetch import PREFETCH_ENABLED, start_prefetch
+from metrics import METRICS_ENABLED, PROFILE_SAMPLE_RATE, PROFILE_SLOW_REQUEST_SECONDS, StackSampler, request_spans, observe, format_server_timing, render_metrics
+
 # Initialize Dash app and Flask server
 app = Dash(use_pages=True, meta_tags=[{"name": "viewport", "content": "width=device-width, initial-scale=1"}])
 server = app.server
@@ -27,8 +34,8 @@ app.layout = html.Div([page_container])
 def launch():
     app.logger.info("Received /launch request")
     reset()
-    app_settings['launch_token'] = request.args.get('launch')
-    smart = get_smart()
+    # The launch token belongs to this launch only, so it goes into this session's client settings
+    smart = get_smart(launch_token=request.args.get('launch'))
     app.logger.info("redirecting to the authorize URL")
     return redirect(smart.authorize_url)
 
@@ -38,9 +45,48 @@ def redirect_uri():
     app.logger.info("Received /redirect_uri request")
     smart = get_smart()
     smart.handle_callback(request.url)
+    # Start reading the patient's data while the browser follows the redirect and loads the page
+    if PREFETCH_ENABLED and smart.patient_id:
+        session['prefetch_key'] = str(uuid.uuid4())
+        start_prefetch(session['prefetch_key'], get_session_id())
+        app.logger.info("Started prefetching the patient's data")
     app.logger.info("redirecting to the /visualization URL")
     return redirect('/visualization')
 
+# Serve the collected metrics in the Prometheus text format
+@server.route('/metrics')
+def metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Time every request, collect its spans, and sample a share of requests with the profiler
+@server.before_request
+def start_request_timing():
+    g.request_started = time.perf_counter()
+    g.request_spans_token = request_spans.set([])
+    g.sampler = StackSampler(threading.get_ident()).start() if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE else None
+
+@server.after_request
+def apply_server_timing(response):
+    elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    observe('http_request_seconds', elapsed, route=route)
+    response.headers['Server-Timing'] = format_server_timing(request_spans.get() or [], elapsed)
+    if g.get('sampler'):
+        g.sampler.stop()
+        # Only the profiles of slow requests, long enough to have samples, are kept
+        if elapsed >= PROFILE_SLOW_REQUEST_SECONDS and g.sampler.stacks:
+            app.logger.info(f"Request to {request.path} took {elapsed:.2f}s, wrote its profile to {g.sampler.write(request.path)}")
+    return response
+
+@server.teardown_request
+def end_request_timing(exception=None):
+    if g.get('sampler'):
+        g.sampler.stop()
+    if 'request_spans_token' in g:
+        request_spans.reset(g.request_spans_token)
+
 # Add X-Frame-Options and CSP header to enable iFraming
 @server.after_request
 def apply_csp(response):
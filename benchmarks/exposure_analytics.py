@@ -0,0 +1,85 @@
+"""
+Micro-benchmark of the exposure metrics (exposure.compute_exposure_metrics) over year-long
+hourly series: the same metrics computed with pandas frames, one location at a time, against the
+numpy engine, one location at a time and for all locations stacked in one array.
+
+Run from the repository root: python benchmarks/exposure_analytics.py [locations] [days]
+"""
+import os
+import sys
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import pandas as pd
+from hourly import HourlyStore, to_datetime64
+from exposure import UAQI_THRESHOLDS, APPARENT_TEMPERATURE_CUTOFF, SMOKE_EXPOSURE_BASELINE, stack_stores, compute_exposure_metrics, summarize_exposure
+
+def make_stores(locations, days, current_dt, seed=0):
+    # Environmental data stores shaped like environment.build_environment_store's, with 4 forecast days and some gaps
+    rng = np.random.default_rng(seed)
+    index = pd.date_range(current_dt.floor('D') - pd.Timedelta(days=days), current_dt.floor('D') + pd.Timedelta(days=4), freq='h', inclusive='left')
+    stores = []
+    for _ in range(locations):
+        aqi = np.clip(60 + 25 * np.sin(np.arange(len(index)) / 90) + rng.normal(0, 10, len(index)), 0, 100)
+        aqi[rng.random(len(index)) < 0.02] = np.nan
+        apparent_temperature = 75 + 20 * np.sin(np.arange(len(index)) / 24 * 2 * np.pi) + rng.normal(0, 3, len(index))
+        store = HourlyStore.spanning(index)
+        for column, values in [('aqi', aqi), ('temperature_2m', apparent_temperature - 3), ('apparent_temperature', apparent_temperature)]:
+            store.add(column, index, values)
+        stores.append(store)
+    return stores
+
+def summarize_with_pandas(environment_df, current_dt):
+    # The core metrics written with pandas operations, as the prompt summary computes its own
+    past = environment_df[environment_df.index <= current_dt]
+    forecast = environment_df[environment_df.index > current_dt]
+    rolling = {window: environment_df['aqi'].rolling(window, min_periods=window // 2).mean() for window in [24, 72]}
+    hot_days = (environment_df['apparent_temperature'] > APPARENT_TEMPERATURE_CUTOFF).resample('D').max()
+    streaks = hot_days.groupby((~hot_days).cumsum()).sum()
+    smoke = (SMOKE_EXPOSURE_BASELINE - environment_df['aqi']).clip(lower=0)
+    return {
+        'current_aqi': past['aqi'].dropna().iloc[-1],
+        **{f'aqi_mean_{window}h': means[means.index <= current_dt].dropna().iloc[-1] for window, means in rolling.items()},
+        'past_smoke_exposure': smoke[smoke.index <= current_dt].sum(),
+        'forecast_smoke_exposure': smoke[smoke.index > current_dt].sum(),
+        **{f'forecast_hours_uaqi_below_{threshold}': (forecast['aqi'] < threshold).sum() for threshold in UAQI_THRESHOLDS},
+        'longest_heat_streak_days': streaks.max(),
+        'forecast_min_aqi': forecast['aqi'].min(),
+        'forecast_min_aqi_time': forecast['aqi'].idxmin(),
+        'forecast_max_apparent_temperature': forecast['apparent_temperature'].max(),
+        'forecast_max_apparent_temperature_time': forecast['apparent_temperature'].idxmax(),
+    }
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+if __name__ == '__main__':
+    locations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 365
+    current_dt = pd.Timestamp('2024-08-15T14:00Z')
+    stores = make_stores(locations, days, current_dt)
+    # pandas works on float64 frames of the stores' data
+    frames = [store.to_frame().astype(float) for store in stores]
+
+    with_pandas, pandas_time = timed(lambda: [summarize_with_pandas(frame, current_dt) for frame in frames])
+    one_by_one, numpy_time = timed(lambda: [summarize_exposure(store, current_dt) for store in stores])
+
+    def stacked():
+        times, arrays = stack_stores(stores)
+        return compute_exposure_metrics(times, arrays['aqi'], arrays['apparent_temperature'], current_dt)
+    stacked_metrics, stacked_time = timed(stacked)
+
+    # The engines must agree before their timings mean anything
+    for name in with_pandas[0]:
+        if name.endswith('_time'):
+            assert (to_datetime64([summary[name] for summary in with_pandas]) == stacked_metrics[name]).all(), name
+        else:
+            expected = np.array([summary[name] for summary in with_pandas], dtype=float)
+            assert np.allclose(expected, stacked_metrics[name]) and np.allclose(expected, [summary[name] for summary in one_by_one]), name
+
+    print(f"{locations} locations x {days + 4} days ({(days + 4) * 24} hours each)")
+    print(f"pandas, one location at a time: {pandas_time * 1000:8.1f} ms")
+    print(f"numpy, one location at a time:  {numpy_time * 1000:8.1f} ms ({pandas_time / numpy_time:.1f}x faster)")
+    print(f"numpy, all locations stacked:   {stacked_time * 1000:8.1f} ms ({pandas_time / stacked_time:.1f}x faster)")
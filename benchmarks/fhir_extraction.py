@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of reading Encounters out of a searchset Bundle: through fhirclient models
+(parse the Bundle into models, serialize each resource back to JSON, then read its fields),
+against the raw JSON path the app uses (records.EncounterRecord.from_json).
+
+Run from the repository root: python benchmarks/fhir_extraction.py [number of encounters]
+"""
+import os
+import sys
+import json
+import time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fhirclient.models.bundle import Bundle
+from records import EncounterRecord, get_encounter_description, get_codes, get_resource_version
+
+def make_bundle(count):
+    # A searchset Bundle of synthetic Encounters, as a FHIR server would return it
+    return {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'total': count,
+        'entry': [{
+            'fullUrl': f'https://fhir.example.org/Encounter/e{i}',
+            'resource': {
+                'resourceType': 'Encounter',
+                'id': f'e{i}',
+                'meta': {'versionId': '1', 'lastUpdated': '2024-01-01T00:00:00Z'},
+                'status': 'finished',
+                'class': {'system': 'http://terminology.hl7.org/CodeSystem/v3-ActCode', 'code': 'AMB', 'display': 'ambulatory'},
+                'type': [{'coding': [{'system': 'http://snomed.info/sct', 'code': '185349003', 'display': 'Encounter for check up'}], 'text': 'Encounter for check up'}],
+                'subject': {'reference': 'Patient/p1'},
+                'period': {'start': f'20{10 + i % 14:02d}-03-01T10:00:00Z', 'end': f'20{10 + i % 14:02d}-03-01T11:00:00Z'},
+            },
+        } for i in range(count)],
+    }
+
+def read_with_models(bundle_json):
+    encounters = []
+    for entry in Bundle(bundle_json).entry or []:
+        encounter = entry.resource.as_json()
+        encounters.append({
+            'id': encounter.get('id'),
+            'version': get_resource_version(encounter),
+            'description': get_encounter_description(encounter),
+            'status': encounter.get('status', 'Unknown'),
+            'codes': get_codes(encounter['type'][0]) if encounter.get('type') else (),
+            'start': (encounter.get('period', {}).get('start') or '')[:10],
+        })
+    return encounters
+
+def read_raw(bundle_json):
+    return [EncounterRecord.from_json(entry['resource']) for entry in bundle_json.get('entry', [])]
+
+def best_of(func, argument, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(argument)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    payload = json.dumps(make_bundle(count))
+    # Both paths start from the response body, so JSON decoding is timed too
+    models = best_of(lambda body: read_with_models(json.loads(body)), payload)
+    raw = best_of(lambda body: read_raw(json.loads(body)), payload)
+    print(f"{count} encounters")
+    print(f"fhirclient models: {models * 1000:8.1f} ms")
+    print(f"raw JSON records:  {raw * 1000:8.1f} ms ({models / raw:.1f}x faster)")
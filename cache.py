@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import closing
+from concurrent.futures import Future
+
+# Directory holding the app's on-disk caches
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache')
+
+class SQLiteCache:
+    """
+    A small persistent key-value cache backed by a local SQLite file, safe to share
+    between threads and worker processes. Values are stored as JSON. Each entry
+    expires 'ttl' seconds after it was written (unless a per-entry ttl is given), and
+    once the table holds more than 'max_entries' the least recently used entries are
+    evicted. Hits and misses served by this process are counted.
+    """
+    def __init__(self, filename, table, ttl, max_entries):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.path = os.path.join(CACHE_DIR, filename)
+        self.table = table
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        with self._connect() as conn, conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )""")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_accessed_at ON {self.table} (accessed_at)")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=10))
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock, self._connect() as conn, conn:
+            row = conn.execute(f"SELECT value, expires_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            if row[1] <= now:
+                conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self.misses += 1
+                return default
+            conn.execute(f"UPDATE {self.table} SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + (self.ttl if ttl is None else ttl)
+        with self._lock, self._connect() as conn, conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now)
+            )
+            # Evict expired entries, then the least recently used ones beyond the size limit
+            conn.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+            conn.execute(f"""
+                DELETE FROM {self.table} WHERE key IN (
+                    SELECT key FROM {self.table} ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
+
+    def delete(self, key):
+        with self._lock, self._connect() as conn, conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls for the same key: the first caller runs the function
+    and every caller that arrives while it is still running waits for, and shares, its
+    result (or exception).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+class SQLiteTimeSeriesStore:
+    """
+    A persistent store of hourly values per series (e.g. per location), backed by a local
+    SQLite file. Timestamps are stored as '%Y-%m-%dT%H:%M:%SZ' strings, which sort
+    chronologically, so the latest stored hour of a series can be looked up cheaply.
+    """
+    def __init__(self, filename, table):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.path = os.path.join(CACHE_DIR, filename)
+        self.table = table
+        self._lock = threading.Lock()
+        with self._connect() as conn, conn:
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} (
+                    series TEXT NOT NULL,
+                    time TEXT NOT NULL,
+                    value REAL,
+                    PRIMARY KEY (series, time)
+                ) WITHOUT ROWID""")
+
+    def _connect(self):
+        return closing(sqlite3.connect(self.path, timeout=10))
+
+    def last_time(self, series):
+        with self._lock, self._connect() as conn:
+            return conn.execute(f"SELECT MAX(time) FROM {self.table} WHERE series = ?", (series,)).fetchone()[0]
+
+    def upsert(self, series, values):
+        # 'values' maps timestamps to values
+        with self._lock, self._connect() as conn, conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (series, time, value) VALUES (?, ?, ?)",
+                [(series, time, value) for time, value in values.items()]
+            )
+
+    def read(self, series, start):
+        # Return the series' values from 'start' onwards, oldest first
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(f"SELECT time, value FROM {self.table} WHERE series = ? AND time >= ? ORDER BY time", (series, start)).fetchall()
+        return dict(rows)
+
+    def prune(self, series, start):
+        # Drop the series' values older than 'start'
+        with self._lock, self._connect() as conn, conn:
+            conn.execute(f"DELETE FROM {self.table} WHERE series = ? AND time < ?", (series, start))
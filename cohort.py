@@ -0,0 +1,296 @@
+# Cohort batch mode - smoke-risk screening for a panel of patients, without a SMART launch
+#
+#   python cohort.py patients.txt --output cohort.parquet [--workers 8] [--resume]
+#
+# 'patients.txt' lists one FHIR Patient id per line. Rows are streamed to a CSV or Parquet file
+# (by its extension) in batches; the ids of written rows are appended to '<output>.checkpoint', so
+# an interrupted run continues where it stopped with --resume.
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file, before the app's modules read their configuration
+load_dotenv()
+
+import argparse
+import csv
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from fhirclient import client
+from fhirclient.auth import FHIROAuth2Auth
+import numpy as np
+from utils import app_settings, fetch_patient_records, get_patient_demographics, http_session
+from geocoding import geocode_address, normalize_address, geocode_cache
+from environment import fetch_environmental_data, to_grid_cell, environment_cache
+from cache import SingleFlight
+from prompts import ACTIVE_CLINICAL_STATUSES
+from exposure import UAQI_THRESHOLDS, APPARENT_TEMPERATURE_CUTOFF, summarize_exposure
+from risk import assess_risk, RISK_CONSULT_LEVEL
+
+# Parquet output needs pyarrow, which is optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logger = logging.getLogger('cohort')
+
+# Output columns and their types
+COHORT_COLUMNS = {
+    'patient_id': 'string',
+    'sex': 'string',
+    'birth_date': 'string',
+    'grid_latitude': 'float',
+    'grid_longitude': 'float',
+    'conditions': 'int',
+    'active_conditions': 'int',
+    'encounters': 'int',
+    'medication_administrations': 'int',
+    'current_aqi': 'float',
+    'aqi_mean_24h': 'float',
+    'forecast_min_aqi': 'float',
+    'forecast_min_aqi_time': 'string',
+    'forecast_min_aqi_mean_24h': 'float',
+    'forecast_smoke_exposure': 'float',
+    **{f'forecast_hours_uaqi_below_{threshold}': 'int' for threshold in UAQI_THRESHOLDS},
+    'forecast_max_apparent_temperature': 'float',
+    'forecast_max_apparent_temperature_time': 'string',
+    f'forecast_hours_apparent_temperature_above_{APPARENT_TEMPERATURE_CUTOFF:g}': 'int',
+    'forecast_heat_streak_days': 'int',
+    'risk_score': 'int',
+    'risk_level': 'string',
+    'risk_factors': 'string',
+    'needs_consult': 'int',
+    'fetch_errors': 'string',
+    'error': 'string',
+    'elapsed_ms': 'float',
+}
+
+def get_cohort_smart():
+    """
+    A FHIR client for the cohort run. It talks to COHORT_API_BASE (default API_BASE) and,
+    when COHORT_ACCESS_TOKEN is set (e.g. from a SMART backend services token request),
+    sends it as a bearer token.
+    """
+    smart = client.FHIRClient(settings={**app_settings, 'api_base': os.getenv('COHORT_API_BASE') or app_settings['api_base']})
+    smart.server.session = http_session
+    if os.getenv('COHORT_ACCESS_TOKEN'):
+        smart.server.auth = FHIROAuth2Auth(state={'access_token': os.getenv('COHORT_ACCESS_TOKEN')})
+    return smart
+
+class CohortEnvironment:
+    """
+    Geocoding and exposure metrics shared by every patient of the run: one geocode per
+    distinct address and one environmental fetch and exposure summary per grid cell,
+    however many patients share them, all for the same current datetime. Environmental
+    requests run on 'executor'.
+    """
+    def __init__(self, current_dt, executor=None):
+        self.current_dt = current_dt
+        self.executor = executor
+        self.exposures = {}
+        self._lock = threading.Lock()
+        self._geocode_single_flight = SingleFlight()
+        self._environment_single_flight = SingleFlight()
+
+    def geocode(self, patient, address):
+        return self._geocode_single_flight.do(normalize_address(address), lambda: geocode_address(patient, address))
+
+    def get_exposure(self, latitude, longitude):
+        cell = to_grid_cell(latitude, longitude)
+        with self._lock:
+            if cell in self.exposures:
+                return cell, self.exposures[cell]
+
+        def fetch():
+            environment_store, _ = fetch_environmental_data(self.current_dt, *cell, executor=self.executor)
+            exposure = summarize_exposure(environment_store, self.current_dt)
+            with self._lock:
+                self.exposures[cell] = exposure
+            return exposure
+        return cell, self._environment_single_flight.do(cell, fetch)
+
+def assess_patient(smart, patient_id, cohort_environment, fhir_executor=None):
+    # One output row for the patient, with its FHIR reads on 'fhir_executor'; failures are recorded in the row's 'error' field
+    started = time.perf_counter()
+    row = {'patient_id': patient_id}
+    try:
+        patient, conditions, medication_administrations, encounters, fetch_errors = fetch_patient_records(SimpleNamespace(server=smart.server, patient_id=patient_id), executor=fhir_executor)
+        _, sex, birth_date, address = get_patient_demographics(patient)
+        row.update({
+            'sex': sex,
+            'birth_date': birth_date,
+            'conditions': len(conditions),
+            'active_conditions': sum(condition.clinical_status in ACTIVE_CLINICAL_STATUSES for condition in conditions),
+            'encounters': len(encounters),
+            'medication_administrations': len(medication_administrations),
+            'fetch_errors': ','.join(fetch_errors),
+        })
+        (row['grid_latitude'], row['grid_longitude']), exposure = cohort_environment.get_exposure(*cohort_environment.geocode(patient, address))
+        row.update({name: value for name, value in exposure.items() if name in COHORT_COLUMNS})
+        risk = assess_risk(birth_date, conditions, medication_administrations, exposure, cohort_environment.current_dt, unavailable=fetch_errors)
+        row.update({
+            'risk_score': risk['score'],
+            'risk_level': risk['level'],
+            'risk_factors': '; '.join(label for label, _ in risk['factors']),
+            'needs_consult': int(risk['needs_consult']),
+        })
+    except Exception as e:
+        logger.warning(f"Could not assess patient {patient_id}: {e!r}")
+        row['error'] = repr(e)
+    row['elapsed_ms'] = (time.perf_counter() - started) * 1000
+    return row
+
+class CohortWriter:
+    """
+    Streams rows to a CSV or Parquet file in batches. Appending to an existing CSV file
+    continues it; Parquet files can't be appended to, so a resumed run writes its rows to
+    the next free '<name>.partN.parquet' file next to it.
+    """
+    def __init__(self, path, columns, resume=False):
+        self.columns = columns
+        self.format = 'parquet' if path.endswith('.parquet') else 'csv'
+        if self.format == 'parquet':
+            if pq is None:
+                raise SystemExit("Writing Parquet needs pyarrow; install it or write a .csv file")
+            part = 0
+            while resume and os.path.exists(path):
+                part += 1
+                path = f"{path[:-len('.parquet')].rsplit('.part', 1)[0]}.part{part}.parquet"
+            types = {'string': pa.string(), 'float': pa.float64(), 'int': pa.int64()}
+            self.schema = pa.schema([(name, types[column_type]) for name, column_type in columns.items()])
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            new_file = not (resume and os.path.exists(path))
+            self.file = open(path, 'a' if not new_file else 'w', newline='')
+            self.writer = csv.DictWriter(self.file, fieldnames=list(columns))
+            if new_file:
+                self.writer.writeheader()
+        self.path = path
+
+    def write(self, rows):
+        if self.format == 'parquet':
+            self.writer.write_table(pa.Table.from_pylist([{name: row.get(name) for name in self.columns} for row in rows], schema=self.schema))
+        else:
+            self.writer.writerows(rows)
+            self.file.flush()
+
+    def close(self):
+        if self.format == 'parquet':
+            self.writer.close()
+        else:
+            self.file.close()
+
+def read_patient_ids(path):
+    # One id per line; blank lines and '#' comments are skipped, duplicates are dropped
+    with open(path) as file:
+        return list(dict.fromkeys(line.strip() for line in file if line.strip() and not line.startswith('#')))
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as file:
+        return {line.strip() for line in file if line.strip()}
+
+def run_cohort(patient_ids, output, workers=8, batch_size=100, resume=False):
+    """
+    Assess every patient with up to 'workers' patients in flight, writing rows in batches of
+    'batch_size' and checkpointing the ids of written rows. Returns the throughput report.
+    """
+    checkpoint_path = f"{output}.checkpoint"
+    if os.path.exists(output) and not resume:
+        raise SystemExit(f"{output} already exists; pass --resume to continue it, or remove it")
+    done = read_checkpoint(checkpoint_path) if resume else set()
+    todo = [patient_id for patient_id in patient_ids if patient_id not in done]
+
+    # The run's own FHIR and environmental pools, sized for its concurrency as each patient fans out to several reads
+    fhir_executor = ThreadPoolExecutor(max_workers=workers * 4, thread_name_prefix='cohort-fhir-fetch')
+    environment_executor = ThreadPoolExecutor(max_workers=workers * 4, thread_name_prefix='cohort-environment-fetch')
+
+    smart = get_cohort_smart()
+    cohort_environment = CohortEnvironment(datetime.now(timezone.utc), environment_executor)
+    writer = CohortWriter(output, COHORT_COLUMNS, resume)
+    started = time.perf_counter()
+    latencies, failed, pending_rows = [], 0, []
+    risk_levels, needs_consult = Counter(), 0
+
+    def flush(checkpoint):
+        writer.write(pending_rows)
+        checkpoint.writelines(f"{row['patient_id']}\n" for row in pending_rows)
+        checkpoint.flush()
+        pending_rows.clear()
+
+    logger.info(f"Assessing {len(todo)} patients ({len(done)} already done) with {workers} workers into {writer.path}")
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cohort') as executor, open(checkpoint_path, 'a') as checkpoint:
+        queued, in_flight = iter(todo), set()
+        try:
+            while True:
+                # Keep a bounded number of patients in flight rather than queueing the whole panel
+                while len(in_flight) < workers * 2:
+                    patient_id = next(queued, None)
+                    if patient_id is None:
+                        break
+                    in_flight.add(executor.submit(assess_patient, smart, patient_id, cohort_environment, fhir_executor))
+                if not in_flight:
+                    break
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    row = future.result()
+                    latencies.append(row['elapsed_ms'])
+                    failed += 'error' in row
+                    if 'risk_level' in row:
+                        risk_levels[row['risk_level']] += 1
+                        needs_consult += row['needs_consult']
+                    pending_rows.append(row)
+                if len(pending_rows) >= batch_size:
+                    flush(checkpoint)
+                    logger.info(f"{len(latencies)}/{len(todo)} patients, {len(latencies) / (time.perf_counter() - started):.1f} patients/s")
+        finally:
+            # Keep the finished rows of an interrupted run, so it resumes after them
+            for future in in_flight:
+                future.cancel()
+            if pending_rows:
+                flush(checkpoint)
+            writer.close()
+            fhir_executor.shutdown(wait=False, cancel_futures=True)
+            environment_executor.shutdown(wait=False, cancel_futures=True)
+
+    elapsed = time.perf_counter() - started
+    return {
+        'output': writer.path,
+        'patients': len(latencies),
+        'failed': failed,
+        'skipped_from_checkpoint': len(done),
+        'elapsed_s': round(elapsed, 2),
+        'patients_per_s': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'latency_p50_ms': round(float(np.percentile(latencies, 50)), 1) if latencies else None,
+        'latency_p95_ms': round(float(np.percentile(latencies, 95)), 1) if latencies else None,
+        'risk_levels': dict(risk_levels),
+        'needs_consult': needs_consult,
+        'consult_level': RISK_CONSULT_LEVEL,
+        'grid_cells': len(cohort_environment.exposures),
+        'geocode_cache': {'hits': geocode_cache.hits, 'misses': geocode_cache.misses},
+        'environment_cache': {'hits': environment_cache.hits, 'misses': environment_cache.misses},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Screen a panel of patients for smoke and heat risk")
+    parser.add_argument('patients', help="file with one FHIR Patient id per line")
+    parser.add_argument('--output', required=True, help="output file, .csv or .parquet")
+    parser.add_argument('--workers', type=int, default=int(os.getenv('COHORT_WORKERS', 8)), help="patients assessed concurrently")
+    parser.add_argument('--batch-size', type=int, default=100, help="rows written (and checkpointed) at a time")
+    parser.add_argument('--resume', action='store_true', help="skip the patients in the output's checkpoint and add to the output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.environ.get('LOGGING_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    report = run_cohort(read_patient_ids(args.patients), args.output, args.workers, args.batch_size, args.resume)
+    print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+import os
+import json
+from datetime import timedelta, datetime, date
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from utils import run_concurrently
+from cache import SQLiteCache, SingleFlight, SQLiteTimeSeriesStore
+from http_client import session
+from hourly import HourlyStore
+from metrics import span
+
+# Bounded worker pool shared by all concurrent environmental data requests
+environment_executor = ThreadPoolExecutor(max_workers=int(os.getenv('ENVIRONMENT_FETCH_WORKERS', 4)), thread_name_prefix='environment-fetch')
+
+# Upstream responses are shared by every location within the same grid cell and bucket: the UTC hour for the
+# forecast and current conditions, and the date range covered for history, which is kept for longer and topped
+# up with the newest hours whenever it falls behind the current hour
+GRID_CELL_DEGREES = float(os.getenv('ENVIRONMENT_GRID_CELL_DEGREES', 0.05))
+HISTORY_CACHE_TTL = float(os.getenv('ENVIRONMENT_HISTORY_CACHE_TTL', 3 * 3600))
+FORECAST_CACHE_TTL = float(os.getenv('ENVIRONMENT_FORECAST_CACHE_TTL', 3600))
+environment_cache = SQLiteCache(
+    'environment.sqlite3',
+    'environment',
+    ttl=FORECAST_CACHE_TTL,
+    max_entries=int(os.getenv('ENVIRONMENT_CACHE_MAX_ENTRIES', 5000))
+)
+environment_single_flight = SingleFlight()
+
+# Days of AQI and temperature history shown; the Google AQI history API only reaches 30 days back,
+# so a longer AQI history builds up in the history store as the location keeps being viewed
+ENVIRONMENT_HISTORY_DAYS = int(os.getenv('ENVIRONMENT_HISTORY_DAYS', 30))
+
+# Rolling window of hourly AQI history kept per grid cell, so repeat views only fetch the newest hours
+AQI_HISTORY_HOURS = int(os.getenv('AQI_HISTORY_HOURS', ENVIRONMENT_HISTORY_DAYS * 24))
+aqi_history_store = SQLiteTimeSeriesStore('aqi_history.sqlite3', 'aqi_history')
+
+# open-meteo's forecast API serves up to 92 past days; older temperature history comes from its archive API,
+# in windows of WEATHER_ARCHIVE_WINDOW_DAYS days fetched concurrently and cached for ARCHIVE_CACHE_TTL seconds
+WEATHER_PAST_DAYS = min(ENVIRONMENT_HISTORY_DAYS, 92)
+WEATHER_ARCHIVE_WINDOW_DAYS = int(os.getenv('WEATHER_ARCHIVE_WINDOW_DAYS', 92))
+ARCHIVE_CACHE_TTL = float(os.getenv('ENVIRONMENT_ARCHIVE_CACHE_TTL', 7 * 86400))
+
+def to_grid_cell(latitude, longitude):
+    # Snap coordinates to the center of their grid cell
+    return (
+        round(round(latitude / GRID_CELL_DEGREES) * GRID_CELL_DEGREES, 6),
+        round(round(longitude / GRID_CELL_DEGREES) * GRID_CELL_DEGREES, 6)
+    )
+
+def hour_bucket(current_dt):
+    return current_dt.strftime('%Y-%m-%dT%H')
+
+def environment_cache_key(source, bucket, latitude, longitude):
+    return f"{source}:{latitude}:{longitude}:{bucket}"
+
+def cached_fetch(source, bucket, latitude, longitude, fetch, ttl):
+    """
+    Return the cached response of 'source' for the grid cell of the given location and
+    'bucket' (e.g. the UTC hour, or the dates the response covers), calling fetch() on a
+    miss and keeping its result for 'ttl' seconds. Concurrent misses for the same key
+    share one in-flight fetch.
+    """
+    key = environment_cache_key(source, bucket, latitude, longitude)
+
+    def fetch_and_store():
+        cached = environment_cache.get(key)
+        if cached is not None:
+            return cached
+        result = fetch()
+        environment_cache.set(key, result, ttl=ttl)
+        return result
+
+    cached = environment_cache.get(key)
+    if cached is not None:
+        return cached
+    return environment_single_flight.do(key, fetch_and_store)
+
+def fetch_aqi_history(latitude, longitude, hours=720):
+    # Retrieve historical AQI for the last 'hours' hours
+    url = f'https://airquality.googleapis.com/v1/history:lookup?key={os.getenv('GOOGLE_MAPS_API_KEY')}'
+    data = {
+            "hours": hours,
+            "pageSize": 720,
+            "location": {
+                "latitude": latitude,
+                "longitude": longitude
+            },
+            "universalAqi": True
+            }
+    aqi_results = {}
+    while True: # A while loop to handle pagination
+        with span('aqi_history_page'):
+            response = session.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
+            response.raise_for_status()
+        for hourly_result in response.json()['hoursInfo']:
+            if 'dateTime' in hourly_result and 'indexes' in hourly_result: aqi_results.update({hourly_result['dateTime']: hourly_result['indexes'][0]['aqi']})
+        if 'nextPageToken' in response.json():
+            data.update({'pageToken': response.json()['nextPageToken']})
+        else:
+            break
+    return aqi_results
+
+def fetch_aqi_history_incremental(current_dt, latitude, longitude):
+    """
+    Return the rolling AQI_HISTORY_HOURS window of hourly AQI history for the location from
+    the local history store, first fetching only the hours after the latest stored one.
+    """
+    series = f"{latitude}:{longitude}"
+    current_hour = current_dt.replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    window_start = (current_hour - timedelta(hours=AQI_HISTORY_HOURS)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    last_time = aqi_history_store.last_time(series)
+    if last_time is None or last_time < window_start:
+        missing_hours = AQI_HISTORY_HOURS
+    else:
+        missing_hours = int((current_hour - datetime.strptime(last_time, '%Y-%m-%dT%H:%M:%SZ')) / timedelta(hours=1))
+    if missing_hours > 0:
+        aqi_history_store.upsert(series, fetch_aqi_history(latitude, longitude, hours=min(missing_hours, 720)))
+
+    aqi_history_store.prune(series, window_start)
+    return aqi_history_store.read(series, window_start)
+
+def fetch_aqi_history_cached(current_dt, latitude, longitude):
+    """
+    Return the AQI history of the location, cached by the dates it covers for
+    HISTORY_CACHE_TTL seconds. A cached history ending before the previous hour is topped
+    up from the history store, which only fetches the hours since, so it always meets the
+    current conditions and forecast without a gap.
+    """
+    bucket = f"{(current_dt - timedelta(hours=AQI_HISTORY_HOURS)).date()}/{current_dt.date()}"
+    history = cached_fetch('history', bucket, latitude, longitude, lambda: fetch_aqi_history_incremental(current_dt, latitude, longitude), HISTORY_CACHE_TTL)
+    previous_hour = (current_dt.replace(minute=0, second=0, microsecond=0, tzinfo=None) - timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    if not history or max(history) >= previous_hour:
+        return history
+
+    key = environment_cache_key('history', bucket, latitude, longitude)
+
+    def top_up():
+        history = fetch_aqi_history_incremental(current_dt, latitude, longitude)
+        environment_cache.set(key, history, ttl=HISTORY_CACHE_TTL)
+        return history
+
+    return environment_single_flight.do(f"{key}:top_up", top_up)
+
+def fetch_aqi_current(latitude, longitude):
+    # Retrieve current AQI
+    url = f'https://airquality.googleapis.com/v1/currentConditions:lookup?key={os.getenv('GOOGLE_MAPS_API_KEY')}'
+    data = {
+        "location": {
+            "latitude": latitude,
+            "longitude": longitude
+        },
+        "universalAqi": True
+    }
+    with span('aqi_current'):
+        response = session.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
+        response.raise_for_status()
+    return {response.json()['dateTime']: response.json()['indexes'][0]['aqi']}
+
+def fetch_aqi_forecast(current_dt, latitude, longitude):
+    # Retrieve forecasted AQI
+    url = f'https://airquality.googleapis.com/v1/forecast:lookup?key={os.getenv('GOOGLE_MAPS_API_KEY')}'
+    data = {
+        "location": {
+            "latitude": latitude,
+            "longitude": longitude
+        },
+        "period": {
+            "startTime": (current_dt + timedelta(hours=1)).strftime(format='%Y-%m-%dT%H:%M:%SZ'),
+            "endTime": (current_dt + timedelta(hours=96)).strftime(format='%Y-%m-%dT%H:%M:%SZ')
+        },
+        "universalAqi": True
+    }
+    aqi_results = {}
+    while True: # A while loop to handle pagination
+        with span('aqi_forecast_page'):
+            response = session.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
+            response.raise_for_status()
+        for hourly_forecast in response.json()['hourlyForecasts']:
+            aqi_results.update({hourly_forecast['dateTime']: hourly_forecast['indexes'][0]['aqi']})
+        if 'nextPageToken' in response.json():
+            data.update({'pageToken': response.json()['nextPageToken']})
+        else:
+            break
+    return aqi_results
+
+def fetch_weather(latitude, longitude):
+    # Retrieve temperature and apparent temperature history, current conditions, and forecast
+    url = "https://api.open-meteo.com/v1/forecast"
+    params = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "current": ["temperature_2m", "apparent_temperature"],
+        "hourly": ["temperature_2m", "apparent_temperature"],
+        "temperature_unit": "fahrenheit",
+        "past_days": WEATHER_PAST_DAYS,
+        "forecast_days": 5,
+        "timezone": "UTC",
+        "timeformat": "unixtime"
+    }
+
+    with span('open_meteo_forecast'):
+        response = session.get(url, params=params)
+        response.raise_for_status()
+    return json.loads(response.content)
+
+def fetch_weather_archive(latitude, longitude, start_date, end_date):
+    # Retrieve temperature and apparent temperature history between two dates (inclusive)
+    url = "https://archive-api.open-meteo.com/v1/archive"
+    params = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+        "hourly": ["temperature_2m", "apparent_temperature"],
+        "temperature_unit": "fahrenheit",
+        "timezone": "UTC",
+        "timeformat": "unixtime"
+    }
+
+    with span('open_meteo_archive'):
+        response = session.get(url, params=params)
+        response.raise_for_status()
+    return json.loads(response.content)
+
+def get_weather_archive_windows(current_dt):
+    """
+    Split the temperature history older than what the forecast API serves into date
+    windows of WEATHER_ARCHIVE_WINDOW_DAYS days. Windows are aligned to fixed dates, and
+    not clipped to the history's start, so their cached responses are reused across days;
+    only the latest window is cut short at the last archived day. Returns (start, end)
+    date pairs, none when the forecast API serves the whole history.
+    """
+    today = current_dt.date()
+    history_start = today - timedelta(days=ENVIRONMENT_HISTORY_DAYS)
+    archive_end = today - timedelta(days=WEATHER_PAST_DAYS + 1)
+    if archive_end < history_start:
+        return []
+    windows = []
+    window_start = date.fromordinal(history_start.toordinal() - history_start.toordinal() % WEATHER_ARCHIVE_WINDOW_DAYS)
+    while window_start <= archive_end:
+        windows.append((window_start, min(window_start + timedelta(days=WEATHER_ARCHIVE_WINDOW_DAYS - 1), archive_end)))
+        window_start += timedelta(days=WEATHER_ARCHIVE_WINDOW_DAYS)
+    return [(start, end) for start, end in windows if start <= end]
+
+def get_archive_cache_ttl(start_date, end_date, current_dt):
+    # A whole window never changes; the latest, cut short, window grows by a day at each UTC midnight
+    if end_date - start_date >= timedelta(days=WEATHER_ARCHIVE_WINDOW_DAYS - 1):
+        return ARCHIVE_CACHE_TTL
+    next_midnight = datetime.combine(current_dt.date() + timedelta(days=1), datetime.min.time(), tzinfo=current_dt.tzinfo)
+    return max((next_midnight - current_dt).total_seconds(), 60)
+
+def clip_open_meteo_response(response, start_date):
+    # The response's hours from the start of 'start_date' (UTC) on
+    times = parse_open_meteo_times(response['hourly']['time'])
+    keep = times >= pd.Timestamp(start_date, tz='UTC')
+    return {**response, 'hourly': {variable: [value for value, kept in zip(values, keep) if kept] for variable, values in response['hourly'].items()}}
+
+def fetch_environmental_data(current_dt, latitude, longitude, executor=None):
+    """
+    Retrieve AQI history, current AQI, AQI forecast, weather and any windows of archived
+    temperature history concurrently. None of these sources depend on each other, so the
+    stage takes as long as the slowest one.
+    Requests are made for the center of the location's grid cell and served from the
+    shared environmental cache when possible. The requests run on 'executor', by default
+    the shared environment_executor.
+    Raises the first error if any source fails or misses the deadline
+    (ENVIRONMENT_FETCH_TIMEOUT, in seconds). Returns the environmental data store (see
+    build_environment_store) and open-meteo's current time as a UTC Timestamp.
+    """
+    latitude, longitude = to_grid_cell(latitude, longitude)
+    tasks = {
+        'forecast': lambda: cached_fetch('forecast', hour_bucket(current_dt), latitude, longitude, lambda: fetch_aqi_forecast(current_dt, latitude, longitude), FORECAST_CACHE_TTL),
+        'currentConditions': lambda: cached_fetch('currentConditions', hour_bucket(current_dt), latitude, longitude, lambda: fetch_aqi_current(latitude, longitude), FORECAST_CACHE_TTL),
+        'history': lambda: fetch_aqi_history_cached(current_dt, latitude, longitude),
+        'weather': lambda: cached_fetch('weather', hour_bucket(current_dt), latitude, longitude, lambda: fetch_weather(latitude, longitude), FORECAST_CACHE_TTL),
+    }
+    archive_windows = get_weather_archive_windows(current_dt)
+    for start_date, end_date in archive_windows:
+        # Bind the window's dates, and key its cache entry by its aligned start rather than by the current hour
+        tasks[f"weather_archive:{start_date}"] = lambda start_date=start_date, end_date=end_date: cached_fetch(
+            'weather_archive', start_date.isoformat(), latitude, longitude,
+            lambda: fetch_weather_archive(latitude, longitude, start_date, end_date), get_archive_cache_ttl(start_date, end_date, current_dt)
+        )
+    results, errors = run_concurrently(executor or environment_executor, tasks, timeout=float(os.getenv('ENVIRONMENT_FETCH_TIMEOUT', 15)))
+    if errors:
+        raise next(iter(errors.values()))
+
+    # Combine AQI results in the same order they were historically retrieved: forecast, current conditions, history
+    aqi_results = {**results['forecast'], **results['currentConditions'], **results['history']}
+    # Aligned windows can start before the history shown
+    history_start = current_dt.date() - timedelta(days=ENVIRONMENT_HISTORY_DAYS)
+    weather_archive = [clip_open_meteo_response(results[f"weather_archive:{start_date}"], history_start) for start_date, _ in archive_windows]
+    with span('environment_build'):
+        return build_environment_store(aqi_results, results['weather'], weather_archive)
+
+def parse_open_meteo_times(times):
+    # open-meteo times are UTC unix seconds; responses cached before timeformat=unixtime was requested carry naive GMT ISO 8601 strings
+    if len(times) and isinstance(times[0], str):
+        return pd.to_datetime(times, utc=True, format='%Y-%m-%dT%H:%M')
+    return pd.to_datetime(times, unit='s', utc=True)
+
+def build_environment_store(aqi_results, weather_response, weather_archive=()):
+    """
+    Build the one columnar representation of the environmental data that the figures, the
+    exposure metrics and the prompt are drawn from: an hourly.HourlyStore on a UTC hourly
+    grid of whole days, with float32 'aqi', 'temperature_2m' and 'apparent_temperature'
+    columns (NaN where a source has no value for that hour). Hourly temperatures from
+    'weather_archive' responses only fill hours the forecast response doesn't cover. Also
+    returns open-meteo's current time as a UTC Timestamp.
+    """
+    aqi_times = pd.to_datetime(list(aqi_results.keys()), utc=True, format='ISO8601')
+    # The forecast response goes last, so its hours win over the archive's
+    weather_responses = [*weather_archive, weather_response]
+    weather_times = [parse_open_meteo_times(response['hourly']['time']) for response in weather_responses]
+    current_time = parse_open_meteo_times([weather_response['current']['time']])[0]
+
+    store = HourlyStore.spanning([current_time, *(time for times in [aqi_times, *weather_times] if len(times) for time in (times.min(), times.max()))])
+    store.add('aqi', aqi_times, list(aqi_results.values()))
+    for response, times in zip(weather_responses, weather_times):
+        for variable in ['temperature_2m', 'apparent_temperature']:
+            store.add(variable, times, np.array(response['hourly'][variable], dtype=float))
+    return store, current_time
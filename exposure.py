@@ -0,0 +1,142 @@
+import os
+import numpy as np
+from hourly import HOUR, to_datetime64, hourly_grid
+
+# Exposure analytics over the hourly AQI and temperature series, on numpy arrays shaped
+# (hours,) for one location or (locations, hours) for many, on a shared UTC hourly grid
+# where missing hours are NaN
+
+UAQI_THRESHOLDS = [40, 20]
+APPARENT_TEMPERATURE_CUTOFF = float(os.getenv('APPARENT_TEMPERATURE_CUTOFF', 90))
+
+# Lower edges of the UAQI bands (see the scale in prompts.generate_prompt)
+UAQI_BANDS = {'poor': 0, 'low': 20, 'moderate': 40, 'good': 60, 'excellent': 80}
+
+# Cumulative smoke exposure counts UAQI points below this baseline, hour by hour
+SMOKE_EXPOSURE_BASELINE = UAQI_THRESHOLDS[0]
+
+# Rolling mean windows, in hours; a window needs at least half its hours to have a mean
+ROLLING_WINDOWS = [24, 72]
+
+def to_hourly_arrays(environment_store, times, columns=('aqi', 'apparent_temperature')):
+    """
+    Float64 copies of columns of an environmental data store (see
+    environment.build_environment_store) on the hourly grid 'times', NaN where the store
+    has no value.
+    """
+    positions = (environment_store.start - times[0]) // HOUR + np.arange(environment_store.length)
+    inside = (positions >= 0) & (positions < len(times))
+    arrays = {}
+    for column in columns:
+        values = np.full(len(times), np.nan)
+        values[positions[inside]] = environment_store[column][inside]
+        arrays[column] = values
+    return arrays
+
+def stack_stores(environment_stores, columns=('aqi', 'apparent_temperature')):
+    # Many locations' stores on one hourly grid spanning all of them: the grid times and a (locations, hours) array per column
+    times = hourly_grid(min(store.times[0] for store in environment_stores), max(store.times[-1] for store in environment_stores))
+    arrays = [to_hourly_arrays(store, times, columns) for store in environment_stores]
+    return times, {column: np.stack([location[column] for location in arrays]) for column in columns}
+
+def rolling_means(values, windows):
+    # NaN-aware trailing means over each of 'windows' hours along the last axis, NaN where fewer than half the hours have values
+    valid = ~np.isnan(values)
+    pad = [(0, 0)] * (values.ndim - 1) + [(1, 0)]
+    sums = np.pad(np.cumsum(np.where(valid, values, 0.0), axis=-1), pad)
+    counts = np.pad(np.cumsum(valid, axis=-1), pad)
+    means = {}
+    for window in windows:
+        # Windows at the start of the series are shorter, from its first hour
+        starts = np.maximum(np.arange(1, values.shape[-1] + 1) - window, 0)
+        window_sums = sums[..., 1:] - sums[..., starts]
+        window_counts = counts[..., 1:] - counts[..., starts]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[window] = np.where(window_counts >= window / 2, window_sums / window_counts, np.nan)
+    return means
+
+def longest_run(flags):
+    # Length of the longest run of True along the last axis
+    runs = np.cumsum(flags, axis=-1)
+    runs = runs - np.maximum.accumulate(np.where(flags, 0, runs), axis=-1)
+    return runs.max(axis=-1, initial=0)
+
+def last_valid(values, mask):
+    # The last non-NaN value where 'mask' is True, along the last axis, or NaN
+    positions = np.where(mask & ~np.isnan(values), np.arange(values.shape[-1]), -1).max(axis=-1, keepdims=True)
+    return np.where(positions[..., 0] >= 0, np.take_along_axis(values, np.maximum(positions, 0), axis=-1)[..., 0], np.nan)
+
+def peak(values, mask, lowest=False):
+    # The lowest or highest non-NaN value where 'mask' is True, along the last axis, and its position (-1 if there is none)
+    fill = np.inf if lowest else -np.inf
+    candidates = np.where(mask & ~np.isnan(values), values, fill)
+    positions = candidates.argmin(axis=-1) if lowest else candidates.argmax(axis=-1)
+    found = np.take_along_axis(candidates, positions[..., None], axis=-1)[..., 0] != fill
+    return np.where(found, np.take_along_axis(values, positions[..., None], axis=-1)[..., 0], np.nan), np.where(found, positions, -1)
+
+def compute_exposure_metrics(times, aqi, apparent_temperature, current_dt):
+    """
+    Exposure metrics of one or many locations, from their 'aqi' and 'apparent_temperature'
+    arrays on the hourly grid 'times' (see hourly_grid; its length must be whole days):
+    current and rolling mean UAQI, cumulative smoke exposure (UAQI-point hours below
+    SMOKE_EXPOSURE_BASELINE), hours below each UAQI threshold and in each band, hours and
+    consecutive days above the apparent temperature cutoff, and the worst forecast values with
+    their timing. Returns a dict of arrays with one value per location.
+    """
+    now = to_datetime64([current_dt])[0]
+    is_forecast = times > now
+    is_past = ~is_forecast
+    valid_aqi = ~np.isnan(aqi)
+
+    metrics = {'current_aqi': last_valid(aqi, is_past)}
+    for window, means in rolling_means(aqi, ROLLING_WINDOWS).items():
+        metrics[f'aqi_mean_{window}h'] = last_valid(means, is_past)
+        metrics[f'forecast_min_aqi_mean_{window}h'], _ = peak(means, is_forecast, lowest=True)
+
+    # NaN hours add nothing to the sums and counts
+    smoke = np.where(valid_aqi, np.clip(SMOKE_EXPOSURE_BASELINE - aqi, 0, None), 0.0)
+    metrics['past_smoke_exposure'] = (smoke * is_past).sum(axis=-1)
+    metrics['forecast_smoke_exposure'] = (smoke * is_forecast).sum(axis=-1)
+    for threshold in UAQI_THRESHOLDS:
+        below = aqi < threshold
+        metrics[f'past_hours_uaqi_below_{threshold}'] = (below & is_past).sum(axis=-1)
+        metrics[f'forecast_hours_uaqi_below_{threshold}'] = (below & is_forecast).sum(axis=-1)
+    bands = np.digitize(aqi, list(UAQI_BANDS.values())[1:])
+    for band_index, band in enumerate(UAQI_BANDS):
+        metrics[f'forecast_hours_uaqi_{band}'] = ((bands == band_index) & valid_aqi & is_forecast).sum(axis=-1)
+
+    hot = apparent_temperature > APPARENT_TEMPERATURE_CUTOFF
+    metrics[f'past_hours_apparent_temperature_above_{APPARENT_TEMPERATURE_CUTOFF:g}'] = (hot & is_past).sum(axis=-1)
+    metrics[f'forecast_hours_apparent_temperature_above_{APPARENT_TEMPERATURE_CUTOFF:g}'] = (hot & is_forecast).sum(axis=-1)
+
+    # Heat streaks: consecutive UTC days with an hour above the cutoff, over the whole series and from today on
+    hot_days = hot.reshape(*hot.shape[:-1], -1, 24).any(axis=-1)
+    is_forecast_day = is_forecast.reshape(-1, 24).any(axis=-1)
+    metrics['longest_heat_streak_days'] = longest_run(hot_days)
+    metrics['forecast_heat_streak_days'] = longest_run(hot_days & is_forecast_day)
+
+    # Forecast peaks and the hours from now until they happen
+    for name, values, lowest in [('forecast_min_aqi', aqi, True), ('forecast_max_apparent_temperature', apparent_temperature, False)]:
+        metrics[name], positions = peak(values, is_forecast, lowest)
+        metrics[f'{name}_time'] = np.where(positions >= 0, times[np.maximum(positions, 0)], np.datetime64('NaT'))
+        metrics[f'{name}_hours_ahead'] = np.where(positions >= 0, (metrics[f'{name}_time'] - now) / HOUR, np.nan)
+    return metrics
+
+def summarize_exposure(environment_store, current_dt):
+    """
+    The exposure metrics (see compute_exposure_metrics) of one location's environmental data
+    store, as plain Python values: floats (NaN when unknown), ints, and peak times as
+    'YYYY-MM-DDTHH:MMZ' strings (None when unknown).
+    """
+    times = hourly_grid(min(environment_store.times[0], to_datetime64([current_dt])[0]), environment_store.times[-1])
+    arrays = to_hourly_arrays(environment_store, times)
+    metrics = compute_exposure_metrics(times, arrays['aqi'], arrays['apparent_temperature'], current_dt)
+    summary = {}
+    for name, value in metrics.items():
+        if np.issubdtype(value.dtype, np.datetime64):
+            summary[name] = None if np.isnat(value) else f"{value.astype('datetime64[m]')}Z"
+        elif np.issubdtype(value.dtype, np.integer):
+            summary[name] = int(value)
+        else:
+            summary[name] = float(value)
+    return summary
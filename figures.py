@@ -1,81 +1,76 @@
-import plotly.graph_objects as go
-import requests
 import os
-import json
-from datetime import timedelta, datetime
+import numpy as np
 import pandas as pd
+import plotly.graph_objects as go
+from dash import Patch
+
+# Points drawn per pixel of the viewport's width, and the point budget used when the width is unknown
+FIGURE_POINTS_PER_PIXEL = float(os.getenv('FIGURE_POINTS_PER_PIXEL', 1))
+FIGURE_DEFAULT_POINTS = int(os.getenv('FIGURE_DEFAULT_POINTS', 1500))
+
+def get_point_budget(viewport_width):
+    return max(int(viewport_width * FIGURE_POINTS_PER_PIXEL), 100) if viewport_width else FIGURE_DEFAULT_POINTS
+
+def lttb(series, threshold):
+    """
+    Downsample a time-indexed series to at most 'threshold' points with Largest-Triangle-
+    Three-Buckets, which keeps the points that shape the line (peaks, troughs, steps).
+    The first and last points are always kept.
+    """
+    if threshold >= len(series) or threshold < 3:
+        return series
+    x = series.index.asi8.astype(float)
+    y = series.to_numpy(dtype=float)
+
+    # Split the inner points into threshold - 2 buckets of (almost) equal size
+    edges = np.linspace(1, len(series) - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0], selected[-1] = 0, len(series) - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # The third vertex is the average of the next bucket (or the last point)
+        next_end = edges[bucket + 2] if bucket + 2 < len(edges) else len(series)
+        next_x, next_y = x[end:next_end].mean(), y[end:next_end].mean()
+        # Keep the bucket's point forming the largest triangle with the previously kept point and the next bucket's average
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous]) - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        previous = start + int(areas.argmax())
+        selected[bucket + 1] = previous
+    return series.iloc[selected]
+
+def window(environment_store, column, start=None, end=None):
+    # A column's values in the [start, end] window, sliced from the store without a copy, without missing values
+    return environment_store.slice(start, end).series(column).dropna()
 
-def generate_aqi_figure(current_dt, latitude, longitude):
-    # retrieve AQI history, current conditions, and forecast, then generate figure and return results
-    aqi_results = {}
-    for time in ['forecast', 'currentConditions', 'history']:
-        url = f'https://airquality.googleapis.com/v1/{time}:lookup?key={os.getenv('GOOGLE_MAPS_API_KEY')}'
-        match time:
-            case 'history': # Retrieve historical AQI
-                data = {
-                        "hours": 720,
-                        "pageSize": 720,
-                        "location": {
-                            "latitude": latitude,
-                            "longitude": longitude
-                        },
-                        "universalAqi": True
-                        }
-                while True: # A while loop to handle pagination
-                    response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-                    for hourly_result in response.json()['hoursInfo']:
-                        if 'dateTime' in hourly_result and 'indexes' in hourly_result: aqi_results.update({hourly_result['dateTime']: hourly_result['indexes'][0]['aqi']})
-                    if 'nextPageToken' in response.json():
-                        data.update({'pageToken': response.json()['nextPageToken']})
-                    else:
-                        break
-            case 'currentConditions': # Retrieve current AQI
-                data = {
-                    "location": {
-                        "latitude": latitude,
-                        "longitude": longitude
-                    },
-                    "universalAqi": True
-                }
-                response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-                aqi_results.update({response.json()['dateTime']: response.json()['indexes'][0]['aqi']})
-            case 'forecast': # Retrieve forecasted AQI
-                data = {
-                    "location": {
-                        "latitude": latitude,
-                        "longitude": longitude
-                    },
-                    "period": {
-                        "startTime": (current_dt + timedelta(hours=1)).strftime(format='%Y-%m-%dT%H:%M:%SZ'),
-                        "endTime": (current_dt + timedelta(hours=96)).strftime(format='%Y-%m-%dT%H:%M:%SZ')
-                    },
-                    "universalAqi": True
-                }
-                while True: # A while loop to handle pagination
-                    response = requests.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(data))
-                    for hourly_forecast in response.json()['hourlyForecasts']:
-                        aqi_results.update({hourly_forecast['dateTime']: hourly_forecast['indexes'][0]['aqi']})
-                    if 'nextPageToken' in response.json():
-                        data.update({'pageToken': response.json()['nextPageToken']})
-                    else:
-                        break
+def to_plot_values(series):
+    # The store's float32 values, rounded as float64 so they serialize as short JSON numbers
+    return series.to_numpy(dtype=float).round(2)
+
+def split_at(series, current_dt, max_points):
+    # Split a series into history and forecast; the (short) forecast may use up to half the point budget
+    history, forecast = series[series.index <= current_dt], series[series.index >= current_dt]
+    forecast_points = min(len(forecast), max_points // 2)
+    return lttb(history, max_points - forecast_points), lttb(forecast, forecast_points)
+
+def build_aqi_figure_template():
+    # Build the static parts of the AQI figure; the traces' data and the "NOW" indicator are filled in per patient by patch_aqi_figure
     # Create figure object
     figure = go.Figure()
 
     # Create the AQI line graph traces
-    figure.add_trace(go.Scatter(
+    figure.add_trace(go.Scattergl(
         showlegend=False,
         name = "History",
-        x=[dt for dt in aqi_results.keys() if dt <= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
-        y=[aqi_results[dt] for dt in aqi_results.keys() if dt <= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
+        x=[],
+        y=[],
         mode='lines',
         line=dict(width=2, color='black')
     ))
-    figure.add_trace(go.Scatter(
+    figure.add_trace(go.Scattergl(
         showlegend=False,
         name = "Forecast",
-        x=[dt for dt in aqi_results.keys() if dt >= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
-        y=[aqi_results[dt] for dt in aqi_results.keys() if dt >= current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ')],
+        x=[],
+        y=[],
         mode='lines',
         line=dict(dash='dot', width=2, color='black')
     ))
@@ -103,11 +98,12 @@ def generate_aqi_figure(current_dt, latitude, longitude):
             opacity= 0.66
         )
 
-    # Add the "NOW" indicator
+    # Add the "NOW" indicator, hidden until it is positioned
     figure.add_shape(
         type = "line",
-        x0 = current_dt,
-        x1 = current_dt,
+        visible = False,
+        x0 = None,
+        x1 = None,
         y0 = 0,
         y1 = 100,
         line = dict(
@@ -171,121 +167,67 @@ def generate_aqi_figure(current_dt, latitude, longitude):
             family='Montserrat'
         ),
         hovermode = "x",
+        uirevision = 'environment',
         plot_bgcolor = 'white',
         paper_bgcolor = '#F1F1F1',
         margin=dict(l=70, r=70, t=0, b=42),
     )
 
-    aqi_df = pd.DataFrame(list(aqi_results.items()), columns=['time', 'aqi'])
-    return figure, aqi_df
-
-def generate_weather_figure(latitude, longitude):
-
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "current": ["temperature_2m", "apparent_temperature"],
-        "hourly": ["temperature_2m", "apparent_temperature"],
-        "temperature_unit": "fahrenheit",
-        "past_days": 29,
-        "forecast_days": 5
-    }
-
-    response = requests.get(url, params=params)
-    response = json.loads(response.content)
-
-    # Extract current data
-    current_data = {
-        "time": [response["current"]["time"]],
-        "temperature_2m": [response["current"]["temperature_2m"]],
-        "apparent_temperature": [response["current"]["apparent_temperature"]]
-    }
-
-    # Extract hourly data
-    hourly_data = {
-        "time": response["hourly"]["time"],
-        "temperature_2m": response["hourly"]["temperature_2m"],
-        "apparent_temperature": response["hourly"]["apparent_temperature"]
-    }
-
-    # Combine current data and hourly data
-    combined_data = {
-        "time": current_data["time"] + hourly_data["time"],
-        "temperature_2m": current_data["temperature_2m"] + hourly_data["temperature_2m"],
-        "apparent_temperature": current_data["apparent_temperature"] + hourly_data["apparent_temperature"]
-    }
-
-    # Create DataFrame
-    weather_df = pd.DataFrame(combined_data)
-
-    # Convert time to datetime for consistent formatting
-    weather_df["time"] = weather_df["time"].apply(lambda x: datetime.strptime(x, '%Y-%m-%dT%H:%M').strftime('%Y-%m-%dT%H:%M:%SZ'))
-    # Sort by time
-    weather_df = weather_df.sort_values(by="time").reset_index(drop=True)
-
-    current_time = response["current"]["time"]
-    # Convert the datetime string to the desired format '%Y-%m-%dT%H:%M:%SZ'
-    current_time = datetime.strptime(current_time, '%Y-%m-%dT%H:%M').strftime('%Y-%m-%dT%H:%M:%SZ')
-
-    # Identify the top and bottom of the temperature range before plotting
-    max_temperature = max(max(weather_df['temperature_2m']), max(weather_df['apparent_temperature']))
-    min_temperature = min(min(weather_df['temperature_2m']), min(weather_df['apparent_temperature']))
-
-    # Split the data into historical and forecast
-    history_mask = weather_df['time'] <= current_time
-    forecast_mask = weather_df['time'] >= current_time
+    return figure
 
+def build_weather_figure_template():
+    # Build the static parts of the temperature figure; the traces' data, the y axis range and the "NOW" indicator are filled in per patient by patch_weather_figure
     # Create the Dash Plotly figure
     figure = go.Figure()
 
     # Temperature history
-    figure.add_trace(go.Scatter(
+    figure.add_trace(go.Scattergl(
         showlegend=True,
         name="Temperature History",
-        x=weather_df[history_mask]['time'],
-        y=weather_df[history_mask]['temperature_2m'],
+        x=[],
+        y=[],
         mode='lines',
         line=dict(width=2, color='black')
     ))
 
     # Temperature forecast
-    figure.add_trace(go.Scatter(
+    figure.add_trace(go.Scattergl(
         showlegend=True,
         name="Temperature Forecast",
-        x=weather_df[forecast_mask]['time'],
-        y=weather_df[forecast_mask]['temperature_2m'],
+        x=[],
+        y=[],
         mode='lines',
         line=dict(dash='dot', width=2, color='black')
     ))
 
     # Apparent temperature history
-    figure.add_trace(go.Scatter(
+    figure.add_trace(go.Scattergl(
         showlegend=True,
         name='"Feels like" History',
-        x=weather_df[history_mask]['time'],
-        y=weather_df[history_mask]['apparent_temperature'],
+        x=[],
+        y=[],
         mode='lines',
         line=dict(width=2, color='red')
     ))
 
     # Apparent temperature forecast
-    figure.add_trace(go.Scatter(
+    figure.add_trace(go.Scattergl(
         showlegend=True,
         name='"Feels like" Forecast',
-        x=weather_df[forecast_mask]['time'],
-        y=weather_df[forecast_mask]['apparent_temperature'],
+        x=[],
+        y=[],
         mode='lines',
         line=dict(dash='dot', width=2, color='red')
     ))
 
-# Add the "NOW" indicator
+    # Add the "NOW" indicator, hidden until it is positioned
     figure.add_shape(
         type = "line",
-        x0 = current_time,
-        x1 = current_time,
-        y0 = min_temperature,
-        y1 = max_temperature,
+        visible = False,
+        x0 = None,
+        x1 = None,
+        y0 = None,
+        y1 = None,
         line = dict(
             color = "#2f2f2d",
             width = 3, 
@@ -316,7 +258,6 @@ def generate_weather_figure(latitude, longitude):
     )
     figure.update_yaxes(
         zeroline = False,
-        range=[min_temperature, max_temperature],
         tickmode='auto',
         ticks='outside',
         ticklen=5,
@@ -347,9 +288,72 @@ def generate_weather_figure(latitude, longitude):
             family='Montserrat'
         ),
         hovermode = "x",
+        uirevision = 'environment',
         plot_bgcolor = '#F1F1F1',
         paper_bgcolor = '#F1F1F1',
         margin=dict(l=70, r=70, t=0, b=42),
     )
     
-    return figure, weather_df
\ No newline at end of file
+    return figure
+
+# The figure skeletons are built once and sent with the page layout; callbacks only send data updates
+AQI_FIGURE_TEMPLATE = build_aqi_figure_template().to_dict()
+WEATHER_FIGURE_TEMPLATE = build_weather_figure_template().to_dict()
+AQI_NOW_SHAPE = len(AQI_FIGURE_TEMPLATE['layout']['shapes']) - 1
+WEATHER_NOW_SHAPE = len(WEATHER_FIGURE_TEMPLATE['layout']['shapes']) - 1
+
+def patch_aqi_traces(patch, current_dt, environment_store, max_points, start=None, end=None):
+    # Fill the AQI history and forecast traces with the [start, end] window of the data, downsampled to the point budget
+    history, forecast = split_at(window(environment_store, 'aqi', start, end), current_dt, max_points)
+    patch['data'][0]['x'] = history.index
+    patch['data'][0]['y'] = to_plot_values(history)
+    patch['data'][1]['x'] = forecast.index
+    patch['data'][1]['y'] = to_plot_values(forecast)
+    return patch
+
+def patch_aqi_figure(current_dt, environment_store, max_points=FIGURE_DEFAULT_POINTS):
+    # Fill the AQI figure template with the AQI history and forecast, split at the current datetime
+    patch = patch_aqi_traces(Patch(), current_dt, environment_store, max_points)
+    patch['layout']['shapes'][AQI_NOW_SHAPE].update({'visible': True, 'x0': current_dt, 'x1': current_dt})
+    return patch
+
+def patch_weather_traces(patch, current_time, environment_store, max_points, start=None, end=None):
+    # Fill the temperature and apparent temperature history and forecast traces with the [start, end] window of the data, downsampled to the point budget
+    for trace, column in [(0, 'temperature_2m'), (2, 'apparent_temperature')]:
+        history, forecast = split_at(window(environment_store, column, start, end), current_time, max_points)
+        patch['data'][trace]['x'] = history.index
+        patch['data'][trace]['y'] = to_plot_values(history)
+        patch['data'][trace + 1]['x'] = forecast.index
+        patch['data'][trace + 1]['y'] = to_plot_values(forecast)
+    return patch
+
+def patch_weather_figure(environment_store, current_time, max_points=FIGURE_DEFAULT_POINTS):
+    # Fill the temperature figure template with the temperature and apparent temperature history and forecast
+    temperatures = np.concatenate([environment_store['temperature_2m'], environment_store['apparent_temperature']]).astype(float)
+
+    # Identify the top and bottom of the temperature range
+    max_temperature = float(np.nanmax(temperatures))
+    min_temperature = float(np.nanmin(temperatures))
+
+    patch = patch_weather_traces(Patch(), current_time, environment_store, max_points)
+    patch['layout']['yaxis']['range'] = [min_temperature, max_temperature]
+    patch['layout']['shapes'][WEATHER_NOW_SHAPE].update({'visible': True, 'x0': current_time, 'x1': current_time, 'y0': min_temperature, 'y1': max_temperature})
+    return patch
+
+def get_zoom_window(relayout_data):
+    """
+    Read the x axis window from a graph's relayoutData: (start, end) UTC Timestamps after
+    a zoom or pan, (None, None) after the zoom is reset, or None for any other relayout.
+    """
+    if not relayout_data:
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        start, end = relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    elif 'xaxis.range' in relayout_data:
+        start, end = relayout_data['xaxis.range']
+    elif relayout_data.get('xaxis.autorange'):
+        return None, None
+    else:
+        return None
+    # Plotly reports the range as wall times in the data's timezone, which is UTC
+    return pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC')
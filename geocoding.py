@@ -0,0 +1,53 @@
+import os
+import threading
+import googlemaps
+from cache import SQLiteCache
+from http_client import session
+from utils import get_address_geolocation
+from metrics import span
+
+# Persistent geocode cache keyed by the normalized address string
+geocode_cache = SQLiteCache(
+    'geocode.sqlite3',
+    'geocode',
+    ttl=float(os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 3600)),
+    max_entries=int(os.getenv('GEOCODE_CACHE_MAX_ENTRIES', 10000))
+)
+
+# Google Maps client, created on first use and shared by every request; the lock keeps concurrent first uses
+# (from the Dash workers and the cohort executor) from each building one
+gmaps = None
+gmaps_lock = threading.Lock()
+
+def get_gmaps():
+    global gmaps
+    with gmaps_lock:
+        if gmaps is None:
+            gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'), requests_session=session)
+        return gmaps
+
+def normalize_address(address):
+    # Lowercase and collapse whitespace so trivially different spellings share a cache entry
+    return ', '.join(' '.join(part.split()) for part in address.lower().split(',') if part.strip())
+
+def geocode_address(patient, address):
+    """
+    Return the (latitude, longitude) of the patient's address. Coordinates from the FHIR
+    Address geolocation extension are used as-is; otherwise the persistent geocode cache
+    is checked before calling the Google Maps Geocoding API.
+    """
+    geolocation = get_address_geolocation(patient)
+    if geolocation:
+        return geolocation
+
+    key = normalize_address(address)
+    cached = geocode_cache.get(key)
+    if cached:
+        return tuple(cached)
+
+    with span('geocode'):
+        geocode_result = get_gmaps().geocode(address)
+    latitude = geocode_result[0]['geometry']['location']['lat']
+    longitude = geocode_result[0]['geometry']['location']['lng']
+    geocode_cache.set(key, [latitude, longitude])
+    return latitude, longitude
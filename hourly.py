@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+
+HOUR = np.timedelta64(1, 'h')
+
+def to_datetime64(timestamps):
+    # UTC datetime64[m] values of a datetime index or list of datetimes; naive ones are taken as UTC
+    index = pd.DatetimeIndex(timestamps)
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    return index.to_numpy().astype('datetime64[m]')
+
+def hourly_grid(start, end):
+    # Hourly datetime64 times from the UTC day of 'start' to the end of the UTC day of 'end', so the grid splits into whole days
+    start = to_datetime64([start])[0].astype('datetime64[D]')
+    end = to_datetime64([end])[0].astype('datetime64[D]') + np.timedelta64(1, 'D')
+    return np.arange(start, end, HOUR)
+
+class HourlyStore:
+    """
+    Environmental variables on one regular UTC time grid: a start time, a step (one hour
+    unless resampled) and one compact float32 array per variable, NaN where there is no
+    value. Variables are added as whole columns, so a new one costs one array. Slices
+    share their arrays with the store they are taken from.
+    """
+    def __init__(self, start, length, step=HOUR, columns=None):
+        self.start = np.datetime64(start, 'm')
+        self.length = length
+        self.step = step
+        self.columns = columns if columns is not None else {}
+
+    @classmethod
+    def spanning(cls, times):
+        # An empty hourly store whose grid covers the whole UTC days of 'times'
+        grid = hourly_grid(min(times), max(times))
+        return cls(grid[0], len(grid))
+
+    @property
+    def times(self):
+        return self.start + np.arange(self.length) * self.step
+
+    @property
+    def index(self):
+        return pd.DatetimeIndex(self.times.astype('datetime64[ns]'), tz='UTC', name='time')
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def add(self, name, times, values):
+        """
+        Put a variable's values on the grid, each in the step its time falls in; values
+        outside the grid are dropped and, of values falling in the same step, the last one
+        wins. Adding to an existing variable fills in or overwrites its values.
+        """
+        column = self.columns.setdefault(name, np.full(self.length, np.nan, dtype=np.float32))
+        positions = (to_datetime64(times) - self.start) // self.step
+        inside = (positions >= 0) & (positions < self.length)
+        column[positions[inside]] = np.asarray(values, dtype=np.float32)[inside]
+
+    def position(self, time):
+        # Index of the step 'time' falls in, clipped to the grid
+        return int(np.clip((to_datetime64([time])[0] - self.start) // self.step, 0, self.length))
+
+    def slice(self, start=None, end=None):
+        # The steps from 'start' up to and including 'end', sharing this store's arrays
+        first = self.position(start) if start is not None else 0
+        last = self.position(end) + 1 if end is not None else self.length
+        last = min(max(last, first), self.length)
+        return HourlyStore(self.start + first * self.step, last - first, self.step, {name: column[first:last] for name, column in self.columns.items()})
+
+    def resample(self, hours, statistic='mean'):
+        # NaN-aware 'mean', 'min' or 'max' over consecutive blocks of 'hours' steps from the start; a last partial block is padded with NaN
+        blocks = -(-self.length // hours)
+        columns = {}
+        for name, column in self.columns.items():
+            values = np.pad(column, (0, blocks * hours - self.length), constant_values=np.nan).reshape(blocks, hours)
+            if statistic == 'mean':
+                counts = np.count_nonzero(~np.isnan(values), axis=1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    columns[name] = (np.nansum(values, axis=1) / counts).astype(np.float32)
+            else:
+                columns[name] = (np.fmin if statistic == 'min' else np.fmax).reduce(values, axis=1)
+        return HourlyStore(self.start, blocks, self.step * hours, columns)
+
+    def to_json(self):
+        # The store as JSON-serializable values; NaN values are kept as NaN, which Python's json module reads back
+        return {'start': str(self.start), 'length': self.length, 'step_minutes': int(self.step / np.timedelta64(1, 'm')), 'columns': {name: column.tolist() for name, column in self.columns.items()}}
+
+    @classmethod
+    def from_json(cls, data):
+        columns = {name: np.array(values, dtype=np.float32) for name, values in data['columns'].items()}
+        return cls(np.datetime64(data['start'], 'm'), data['length'], np.timedelta64(data['step_minutes'], 'm'), columns)
+
+    def series(self, name):
+        return pd.Series(self.columns[name], index=self.index, name=name, copy=False)
+
+    def to_frame(self, names=None):
+        return pd.DataFrame({name: self.columns[name] for name in names or self.columns}, index=self.index)
@@ -0,0 +1,73 @@
+import os
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
+from http.cookiejar import DefaultCookiePolicy
+from dash import get_app
+from metrics import observe
+
+# Outbound HTTP configuration shared by every upstream API call
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv('HTTP_BACKOFF_FACTOR', 0.5))
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', 10))
+HTTP_POOL_CONNECTIONS_PER_HOST = int(os.getenv('HTTP_POOL_CONNECTIONS_PER_HOST', 10))
+
+class PooledSession(requests.Session):
+    """
+    A requests Session that keeps connections alive in a bounded pool per host, retries
+    idempotent requests (and the Air Quality API's read-only POSTs) answered with 429 or
+    5xx with exponential backoff, applies a default timeout, and records the latency of every
+    response by host and status. It is shared by every user, so it never keeps cookies: one
+    clinician's cookies must not be sent on another's requests.
+    """
+    def __init__(self):
+        super().__init__()
+        # Only the default idempotent methods are retried: a POST such as the single-use authorization code exchange must not be repeated
+        adapter = make_adapter(Retry.DEFAULT_ALLOWED_METHODS)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        # The Air Quality API's lookups are POSTs that only read data, so they are safe to retry
+        self.mount('https://airquality.googleapis.com/', make_adapter(Retry.DEFAULT_ALLOWED_METHODS | {'POST'}))
+        self.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.hooks['response'].append(log_latency)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        return super().request(method, url, **kwargs)
+
+def make_adapter(allowed_methods):
+    # A pooled adapter retrying the given methods when answered with 429 or 5xx
+    retry = Retry(
+        total=HTTP_MAX_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=allowed_methods,
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    return HTTPAdapter(
+        pool_connections=HTTP_POOL_HOSTS,
+        pool_maxsize=HTTP_POOL_CONNECTIONS_PER_HOST,
+        pool_block=True,
+        max_retries=retry
+    )
+
+def get_logger():
+    # The Dash app's logger, or this module's when running without the app (e.g. the cohort CLI)
+    try:
+        return get_app().logger
+    except Exception:
+        return logging.getLogger(__name__)
+
+def log_latency(response, *args, **kwargs):
+    # Query strings are left out, as they can carry API keys
+    url = urlsplit(response.url)
+    observe('upstream_request_seconds', response.elapsed.total_seconds(), host=url.netloc, status=response.status_code)
+    get_logger().debug(f"{response.request.method} {url.netloc}{url.path} -> {response.status_code} in {response.elapsed.total_seconds() * 1000:.0f}ms")
+
+# The pooled session used for all outbound calls
+session = PooledSession()
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from cache import CACHE_DIR
+
+# Timing spans around each stage of a page load, kept as in-process Prometheus-style histograms
+# (served on /metrics) and reported per request in its Server-Timing header
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_PREFIX = 'climate_consult'
+
+# Histogram bucket upper bounds, in seconds and in tokens
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60]
+TOKEN_BUCKETS = [250, 500, 1000, 2000, 4000, 8000, 16000, 32000]
+
+# Help text of each metric, also the list of metrics that are served
+METRIC_HELP = {
+    'span_seconds': ('histogram', "Duration of instrumented stages, by span and detail (e.g. the resource type)"),
+    'http_request_seconds': ('histogram', "Duration of the HTTP requests served, by route"),
+    'upstream_request_seconds': ('histogram', "Duration of outbound API calls, by host and response status"),
+    'prompt_tokens': ('histogram', "Estimated size of the consultation prompts sent to Gemini, in tokens"),
+    'gemini_tokens_total': ('counter', "Tokens reported by Gemini, by kind (prompt or output)"),
+    'consultation_cache_total': ('counter', "Consultation cache lookups, by result (hit or miss)"),
+    'profiles_written_total': ('counter', "Sampling profiles written for slow requests"),
+}
+
+# Sampling profiler for slow requests: a share of requests is sampled, and the profile of those
+# slower than PROFILE_SLOW_REQUEST_SECONDS is written to PROFILE_DIR as folded stacks
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_REQUEST_SECONDS = float(os.getenv('PROFILE_SLOW_REQUEST_SECONDS', 5))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.01))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(CACHE_DIR, 'profiles'))
+
+# Histogram series are [bucket counts..., sum, count] lists and counter series are values, keyed by metric name and label values
+histograms = {}
+counters = {}
+metrics_lock = threading.Lock()
+
+# The spans of the request being served, as (name, detail, seconds) tuples; None outside of a request
+request_spans = contextvars.ContextVar('request_spans', default=None)
+
+def to_labels(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def observe(name, value, buckets=SECONDS_BUCKETS, **labels):
+    # Add a value to a histogram
+    if not METRICS_ENABLED:
+        return
+    with metrics_lock:
+        metric = histograms.setdefault(name, {'buckets': buckets, 'series': {}})
+        series = metric['series'].setdefault(to_labels(labels), [0] * (len(buckets) + 2))
+        for position, bound in enumerate(buckets):
+            if value <= bound:
+                series[position] += 1
+        series[-2] += value
+        series[-1] += 1
+
+def increment(name, value=1, **labels):
+    # Add to a counter
+    if not METRICS_ENABLED:
+        return
+    with metrics_lock:
+        series = counters.setdefault(name, {})
+        series[to_labels(labels)] = series.get(to_labels(labels), 0) + value
+
+def record_span(name, seconds, detail=None):
+    observe('span_seconds', seconds, span=name, detail=detail or '')
+    spans = request_spans.get()
+    if spans is not None:
+        spans.append((name, detail, seconds))
+
+@contextmanager
+def span(name, detail=None):
+    """
+    Time the enclosed block as the span 'name', with an optional 'detail' (e.g. the
+    resource type), into the span histogram and the current request's Server-Timing.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - started, detail)
+
+def in_current_context(func):
+    # Run 'func' in a copy of the caller's context, so spans timed in a worker thread count towards the caller's request
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
+
+def format_server_timing(spans, total_seconds):
+    # One Server-Timing entry per span name and detail, summing repeated spans (e.g. pages) and noting their count
+    totals = {}
+    for name, detail, seconds in spans:
+        total = totals.setdefault((name, detail), [0.0, 0])
+        total[0] += seconds
+        total[1] += 1
+    entries = [f"total;dur={total_seconds * 1000:.1f}"]
+    for (name, detail), (seconds, count) in totals.items():
+        description = ' '.join(part for part in [detail, f"x{count}" if count > 1 else None] if part)
+        entries.append(f"{name};dur={seconds * 1000:.1f}" + (f';desc="{description}"' if description else ''))
+    return ', '.join(entries)
+
+def format_labels(labels, extra=()):
+    labels = [*labels, *extra]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+def render_metrics():
+    # All metrics in the Prometheus text exposition format
+    lines = []
+    with metrics_lock:
+        for name, (metric_type, help_text) in METRIC_HELP.items():
+            full_name = f"{METRICS_PREFIX}_{name}"
+            lines += [f"# HELP {full_name} {help_text}", f"# TYPE {full_name} {metric_type}"]
+            if metric_type == 'histogram':
+                metric = histograms.get(name, {'buckets': [], 'series': {}})
+                for labels, series in metric['series'].items():
+                    for bound, count in zip(metric['buckets'], series):
+                        lines.append(f"{full_name}_bucket{format_labels(labels, [('le', f'{bound:g}')])} {count}")
+                    lines.append(f"{full_name}_bucket{format_labels(labels, [('le', '+Inf')])} {series[-1]}")
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {series[-2]:g}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {series[-1]}")
+            else:
+                for labels, value in counters.get(name, {}).items():
+                    lines.append(f"{full_name}{format_labels(labels)} {value:g}")
+    return '\n'.join(lines) + '\n'
+
+class StackSampler:
+    """
+    A sampling profiler: a background thread records the stacks of the other threads every
+    'interval' seconds, as counts of folded stacks (one 'thread;outer;...;inner' line per
+    distinct stack, the input format of flame graph tools). Idle threads, waiting in the
+    threading or queue modules, are left out, except for 'thread_id' (the request's thread).
+    """
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == threading.get_ident():
+                    continue
+                if thread_id != self.thread_id and os.path.basename(frame.f_code.co_filename) in ['threading.py', 'queue.py']:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[';'.join([thread_names.get(thread_id, str(thread_id)), *reversed(stack)])] += 1
+
+    def write(self, name):
+        # Write the folded stacks, most sampled first, to a file in PROFILE_DIR; returns its path
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}-{''.join(c if c.isalnum() else '_' for c in name).strip('_')}.folded")
+        with open(path, 'w') as file:
+            file.writelines(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        increment('profiles_written_total')
+        return path
@@ -1,64 +1,210 @@
 # Dash page - /visualization
 import dash
-from dash import html, dcc, callback, Input, Output, get_app
+from dash import html, dcc, callback, clientside_callback, Input, Output, State, Patch, get_app
 from dash.exceptions import PreventUpdate
-from utils import get_smart, generate_iframe, generate_prompt, generate_clinical_details_table, get_patient_demographics, fetch_all_resources
-from figures import generate_aqi_figure, generate_weather_figure
+from utils import get_smart, generate_iframe, generate_clinical_details_table, get_patient_demographics, fetch_patient_records
+from figures import AQI_FIGURE_TEMPLATE, WEATHER_FIGURE_TEMPLATE, patch_aqi_figure, patch_weather_figure, patch_aqi_traces, patch_weather_traces, get_point_budget, get_zoom_window
+from environment import fetch_environmental_data
+from prefetch import take_prefetch
+from risk import assess_risk
+from exposure import summarize_exposure
+from flask import session
+from geocoding import geocode_address
+from prompts import generate_prompt, build_clinical_summary, summarize_environmental_data, estimate_tokens, fingerprint_consultation_inputs, format_peak
+from cache import SQLiteCache
+from records import ConditionRecord, EncounterRecord, MedicationAdministrationRecord, dump_records, load_records
+from hourly import HourlyStore
 from fhirclient.models.patient import Patient
-from fhirclient.models.condition import Condition
-from fhirclient.models.encounter import Encounter
-from fhirclient.models.medicationadministration import MedicationAdministration
-import googlemaps
+from metrics import TOKEN_BUCKETS, span, record_span, observe, increment
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 import os
-import google.generativeai as genai
+import time
+import threading
+import uuid
 import pandas as pd
+import google.generativeai as genai
 
 dash.register_page(__name__, path='/visualization')
 app = get_app()
 
+# Configure the Gemini client once, so its connection is reused across requests
+genai.configure(api_key=os.getenv('GOOGLE_GEMINI_API_KEY'))
+
+# Data fetched by one callback stage and shared server-side with the stages that follow it, keyed by page load and
+# stage. It is kept in the shared SQLite store, so whichever worker process serves the next stage, a zoom or a poll
+# finds it; each process also keeps the entries it has decoded, so repeat reads on the same worker skip the decoding
+PAGE_DATA_TTL = float(os.getenv('PAGE_DATA_TTL', 900))
+PAGE_DATA_MAX_ENTRIES = int(os.getenv('PAGE_DATA_MAX_ENTRIES', 256))
+# A page load stores up to three entries: its records, its environmental data and its consultation
+page_store = SQLiteCache('pages.sqlite3', 'page_data', ttl=PAGE_DATA_TTL, max_entries=3 * PAGE_DATA_MAX_ENTRIES)
+page_data = TTLCache(maxsize=PAGE_DATA_MAX_ENTRIES, ttl=PAGE_DATA_TTL)
+page_data_lock = threading.Lock()
+
+# Environmental data prefetched for a page load; the prefetch runs in this process, so these stay local
+prefetched_environments = TTLCache(maxsize=PAGE_DATA_MAX_ENTRIES, ttl=PAGE_DATA_TTL)
+
+# Marker shown next to each rule-based risk level
+RISK_LEVEL_ICONS = {'low': '🟢', 'moderate': '🟠', 'high': '🔴'}
+
+# How each resource type is named on the page
+RESOURCE_TYPE_LABELS = {'Condition': "conditions", 'MedicationAdministration': "medication administrations", 'Encounter': "encounters"}
+
+def encode_page_data(stage, data):
+    # The JSON stored for a stage's data: the records stage holds the patient and their records, the environment stage the environmental data
+    if stage == 'records':
+        return {
+            **data,
+            'patient': data['patient'].as_json(),
+            'conditions': dump_records(data['conditions']),
+            'encounters': dump_records(data['encounters']),
+            'medication_administrations': dump_records(data['medication_administrations']),
+        }
+    return {
+        'current_dt': data['current_dt'].isoformat(),
+        'weather_current_time': data['weather_current_time'].isoformat(),
+        'environment_store': data['environment_store'].to_json(),
+    }
+
+def decode_page_data(stage, data):
+    if stage == 'records':
+        return {
+            **data,
+            'patient': Patient(data['patient']),
+            'conditions': load_records(ConditionRecord, data['conditions']),
+            'encounters': load_records(EncounterRecord, data['encounters']),
+            'medication_administrations': load_records(MedicationAdministrationRecord, data['medication_administrations']),
+        }
+    return {
+        'current_dt': datetime.fromisoformat(data['current_dt']),
+        'weather_current_time': pd.Timestamp(data['weather_current_time']),
+        'environment_store': HourlyStore.from_json(data['environment_store']),
+    }
+
+def save_page_data(key, stage, data):
+    page_store.set(f"{key}:{stage}", encode_page_data(stage, data))
+    with page_data_lock:
+        page_data[(key, stage)] = data
+
+def get_page_data(key, stage):
+    # A stage's data for the page load, from this process's decoded entries or the shared store
+    if not key:
+        raise PreventUpdate("This page load has no data")
+    with page_data_lock:
+        data = page_data.get((key, stage))
+    if data is None:
+        stored = page_store.get(f"{key}:{stage}")
+        if stored is None:
+            raise PreventUpdate("The data for this page load has expired or was never fetched")
+        data = decode_page_data(stage, stored)
+        with page_data_lock:
+            page_data[(key, stage)] = data
+    return data
+
+# Stream the consultation into the page as it is generated, instead of waiting for the full text
+GEMINI_STREAMING = os.getenv('GEMINI_STREAMING', 'true').lower() == 'true'
+consultation_executor = ThreadPoolExecutor(max_workers=int(os.getenv('GEMINI_WORKERS', 4)), thread_name_prefix='gemini')
+
+# Consultations keyed by a fingerprint of their inputs, so reopening an unchanged chart doesn't pay for a new generation
+consultation_cache = SQLiteCache(
+    'consultations.sqlite3',
+    'consultations',
+    ttl=float(os.getenv('CONSULTATION_CACHE_TTL', 3600)),
+    max_entries=int(os.getenv('CONSULTATION_CACHE_MAX_ENTRIES', 1000))
+)
+
+def cache_consultation(fingerprint, text):
+    consultation_cache.set(fingerprint, {'text': text, 'generated_at': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M UTC')})
+
+def count_gemini_tokens(response):
+    # Add the prompt and output token counts Gemini reports (on the last chunk, when streaming) to the token counters
+    usage = getattr(response, 'usage_metadata', None)
+    for kind, field in [('prompt', 'prompt_token_count'), ('output', 'candidates_token_count')]:
+        if getattr(usage, field, None):
+            increment('gemini_tokens_total', getattr(usage, field), kind=kind)
+
+def save_consultation(key, text, done=False, error=False):
+    # The consultation generated so far, in the shared store, for whichever worker serves the page's polls
+    page_store.set(f"{key}:consultation", {'text': text, 'done': done, 'error': error})
+
+def stream_consultation(model, prompt, key, fingerprint):
+    # Save the consultation after each generated chunk, recording the time to first token
+    started = time.perf_counter()
+    chunks = []
+    chunk = None
+    error = False
+    try:
+        for chunk in model.generate_content(prompt, stream=True):
+            if not chunks:
+                time_to_first_token = time.perf_counter() - started
+                record_span('gemini_first_token', time_to_first_token)
+                app.logger.info(f"Gemini time to first token: {time_to_first_token:.2f}s")
+            chunks.append(chunk.text)
+            save_consultation(key, ''.join(chunks))
+        count_gemini_tokens(chunk)
+        cache_consultation(fingerprint, ''.join(chunks))
+    except Exception:
+        app.logger.error("An error occurred while streaming the Gemini consultation", exc_info=True)
+        error = True
+    finally:
+        record_span('gemini_stream', time.perf_counter() - started)
+        app.logger.info(f"Gemini consultation finished in {time.perf_counter() - started:.2f}s")
+        save_consultation(key, ''.join(chunks), done=True, error=error)
+
 # Define the layout
 layout = html.Div(id='appcontainer', children=[
     dcc.Location(id='url'),
-    dcc.Loading(parent_className='loading-div', type='cube', color = '#ff8000', fullscreen=True, children=[
-        html.Div(id='header', children="🌎 CLIMATE CONSULT 🩺"),
-        html.Div(id='consultation-row', children=[
-            html.Div(className='left-column', children=[
-                dcc.Markdown(id='patient-details'),
-                html.Div(id='clinical-details-div', children=[
-                    dcc.Tabs(id='clinical-details-table', children=[
-                        dcc.Tab(id='conditions', label="Conditions", className='health-records-tab-label', selected_className='health-records-selected-tab-label'),
-                        dcc.Tab(id='encounters', label="Encounters", className='health-records-tab-label', selected_className='health-records-selected-tab-label'),
-                        dcc.Tab(id='medications', label="Medication Administrations", className='health-records-tab-label', selected_className='health-records-selected-tab-label')
-                    ]),
+    dcc.Store(id='records-key'),
+    dcc.Store(id='environment-key'),
+    dcc.Store(id='viewport-width'),
+    dcc.Interval(id='consultation-interval', interval=500, disabled=True),
+    html.Div(id='header', children="🌎 CLIMATE CONSULT 🩺"),
+    html.Div(id='consultation-row', children=[
+        dcc.Loading(parent_className='left-column', type='cube', color='#ff8000', children=[
+            dcc.Markdown(id='patient-details'),
+            html.Div(id='clinical-details-div', children=[
+                dcc.Tabs(id='clinical-details-table', children=[
+                    dcc.Tab(id='conditions', label="Conditions", className='health-records-tab-label', selected_className='health-records-selected-tab-label'),
+                    dcc.Tab(id='encounters', label="Encounters", className='health-records-tab-label', selected_className='health-records-selected-tab-label'),
+                    dcc.Tab(id='medications', label="Medication Administrations", className='health-records-tab-label', selected_className='health-records-selected-tab-label')
                 ]),
             ]),
-            html.Div(className='right-column', children=[
-                html.H3(children="⚠️ WARNING: This consultation has been generated by AI. A qualified human healthcare professional must review and validate these findings before taking any clinical action."),
+        ]),
+        html.Div(className='right-column', children=[
+            dcc.Markdown(id='risk-score'),
+            html.H3(children="⚠️ WARNING: This consultation has been generated by AI. A qualified human healthcare professional must review and validate these findings before taking any clinical action."),
+            dcc.Loading(parent_className='stage-loading', type='cube', color='#ff8000', delay_show=1000, children=[
                 dcc.Markdown(id='gemini-response')
             ])
-        ]),
-        html.Div(id='environmental-data-row', children=[
-            html.Div(id='location-div', children=[
-                    html.H3(id='address'),
-                    html.Iframe(id='map-iframe', referrerPolicy="no-referrer-when-downgrade")
-                ]),
-            dcc.Tabs(id='environmental-data-tabs', parent_className="environmental-data-tabs", content_className="figure-tab", children=[
-                    dcc.Tab(id='aqi-tab', label="😶‍🌫️ Air Quality", className='environmental-data-tab-label', selected_className='environmental-data-selected-tab-label', children=[
+        ])
+    ]),
+    html.Div(id='environmental-data-row', children=[
+        html.Div(id='location-div', children=[
+                html.H3(id='address'),
+                html.Iframe(id='map-iframe', referrerPolicy="no-referrer-when-downgrade")
+            ]),
+        dcc.Tabs(id='environmental-data-tabs', parent_className="environmental-data-tabs", content_className="figure-tab", children=[
+                dcc.Tab(id='aqi-tab', label="😶‍🌫️ Air Quality", className='environmental-data-tab-label', selected_className='environmental-data-selected-tab-label', children=[
+                    dcc.Loading(parent_className='stage-loading', type='cube', color='#ff8000', children=[
                         dcc.Graph(id='aqi-graph',
+                                  figure=AQI_FIGURE_TEMPLATE,
                                   config={
                                     'displayModeBar': False  # This hides the floating toolbar
                                 })
-                    ]),
-                    dcc.Tab(id='temperature-tab', label="🌡️ Temperature", className='environmental-data-tab-label', selected_className='environmental-data-selected-tab-label', children=[
+                    ])
+                ]),
+                dcc.Tab(id='temperature-tab', label="🌡️ Temperature", className='environmental-data-tab-label', selected_className='environmental-data-selected-tab-label', children=[
+                    dcc.Loading(parent_className='stage-loading', type='cube', color='#ff8000', children=[
                         dcc.Graph(id='temperature-graph',
+                                  figure=WEATHER_FIGURE_TEMPLATE,
                                   config={
                                     'displayModeBar': False  # This hides the floating toolbar
                                 })
-                    ]),
-                ])
-        ]),
-    ])
+                    ])
+                ]),
+            ])
+    ]),
 ])
 
 @callback(
@@ -68,18 +214,32 @@ layout = html.Div(id='appcontainer', children=[
     Output('medications', 'children'),
     Output('address', 'children'),
     Output('map-iframe', 'src'),
-    Output('gemini-response', 'children'),
-    Output('aqi-graph', 'figure'),
-    Output('temperature-graph', 'figure'),
+    Output('records-key', 'data'),
     Input('url', 'href')
 )
 def handle_callback(href):
-    smart = get_smart()
-    # Retrieve FHIR resources
-    patient = Patient.read(rem_id=smart.patient_id, server=smart.server)
-    conditions = fetch_all_resources(Condition, smart)
-    medication_administrations = fetch_all_resources(MedicationAdministration, smart)
-    encounters = fetch_all_resources(Encounter, smart)
+    # Stage 1: demographics and clinical tables
+    # Use the records prefetched when the launch was authorized, if any, otherwise retrieve FHIR resources concurrently
+    prefetched = take_prefetch(session.pop('prefetch_key', None))
+    records = None
+    if prefetched:
+        try:
+            with span('patient_records', 'prefetched'):
+                records = prefetched['records'].result(timeout=float(os.getenv('FHIR_FETCH_TIMEOUT', 20)))
+            app.logger.info("Using the prefetched patient records")
+        except Exception as e:
+            app.logger.warning(f"Could not prefetch the patient records, retrieving them again: {e!r}")
+    try:
+        if records is None:
+            with span('patient_records'):
+                records = fetch_patient_records(get_smart())
+        patient, conditions, medication_administrations, encounters, fetch_errors = records
+    except Exception as e:
+        app.logger.error("An error occurred while reading the patient", exc_info=True)
+        raise PreventUpdate("Something went wrong retrieving the patient")
+    for resource_type, error in fetch_errors.items():
+        app.logger.warning(f"Could not retrieve {resource_type} resources, continuing with partial results: {error!r}")
+    fetch_warning = f"⚠️ Could not retrieve the patient's {' or '.join(RESOURCE_TYPE_LABELS.get(resource_type, resource_type) for resource_type in fetch_errors)}; the risk score and the consultation treat them as unknown, not absent." if fetch_errors else ""
     # Check if address is not null
     if not (hasattr(patient, 'address') and len(patient.address) != 0):
         raise PreventUpdate("No address found for the patient.")
@@ -92,57 +252,234 @@ def handle_callback(href):
         raise PreventUpdate("Something went wrong processing the patient's demographics")
     # Generate UI tables
     try:
-        conditions_table, encounters_table, medication_administrations_table = generate_clinical_details_table(conditions, encounters, medication_administrations)
-        # Convert FHIR resources retrieved to JSON serializable lists
-        conditions = [condition.as_json() for condition in conditions]
-        encounters = [encounter.as_json() for encounter in encounters]
-        medication_administrations = [medication_administration.as_json() for medication_administration in medication_administrations]
+        with span('clinical_tables'):
+            conditions_table, encounters_table, medication_administrations_table = generate_clinical_details_table(conditions, encounters, medication_administrations)
     except Exception as e:
         app.logger.error("An error occurred while parsing the patient's FHIR resources", exc_info=True)
         raise PreventUpdate("Something went wrong processing the patient's health records")
 
-    # Retrieve latitude + longitude of patient's address / retrieve embeddable google maps iFrame
-    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
-    # Geocoding an address
-    geocode_result = gmaps.geocode(address)
-    latitude = geocode_result[0]['geometry']['location']['lat']
-    longitude = geocode_result[0]['geometry']['location']['lng']
     # Get iFrame
     maps_iframe = generate_iframe(address)
 
-    # Generate environmental data and figures
-    current_dt = datetime.now(timezone.utc)
-    aqi_figure, aqi_results = generate_aqi_figure(current_dt, latitude, longitude)
-    weather_figure, weather_results = generate_weather_figure(latitude, longitude)
-    combined_environmental_data = pd.merge(aqi_results, weather_results, on='time', how='outer')
+    # Share the fetched records with the environment and consultation stages
+    key = str(uuid.uuid4())
+    save_page_data(key, 'records', {
+        'patient': patient,
+        'address': address,
+        'birth_date': birthday,
+        'conditions': conditions,
+        'encounters': encounters,
+        'medication_administrations': medication_administrations,
+        'fetch_errors': list(fetch_errors),
+    })
+    if prefetched:
+        with page_data_lock:
+            prefetched_environments[key] = prefetched['environment']
 
-    # Ask google gemini to make a recommendation for the patient, given their age, sex, health records, and AQI forecast.
-    genai.configure(api_key=os.getenv('GOOGLE_GEMINI_API_KEY'))
-    model = genai.GenerativeModel(os.getenv('GOOGLE_GEMINI_MODEL'))
-    prompt = generate_prompt(
-        patient.gender,
-        patient.birthDate.isostring,
-        conditions,
-        encounters,
-        medication_administrations,
-        current_dt.strftime(format='%Y-%m-%dT%H:%M:%SZ'),
-        combined_environmental_data.to_string(index=False, header=True)
-    )
-    gemini_response = model.generate_content(prompt)
-
-
-    # Render the patient's details, records, detected address, and AQI visualization
+    # Render the patient's details, records, and detected address
     return (
         f"""
         
         ### 👤 {name}
-        Identifier: **12345** | Date of Birth: **{birthday}** | Sex: **{sex}**""",
+        Identifier: **12345** | Date of Birth: **{birthday}** | Sex: **{sex}**
+
+        {fetch_warning}""",
         conditions_table,
         encounters_table,
         medication_administrations_table,
         f"📍 {address}",
         maps_iframe,
-        gemini_response.text,
-        aqi_figure,
-        weather_figure
-    )
\ No newline at end of file
+        key
+    )
+
+def format_risk(risk, exposure):
+    factors = ', '.join(f"{label} (+{points})" for label, points in risk['factors']) or "None found"
+    missing = f"\n\n    ⚠️ Incomplete: the patient's {' and '.join(RESOURCE_TYPE_LABELS[resource_type] for resource_type in risk['missing'])} could not be retrieved, so the score may be understated." if risk['missing'] else ""
+    return f"""
+    ### {RISK_LEVEL_ICONS[risk['level']]} Rule-based risk: **{risk['level'].upper()}** (score {risk['score']})
+    Contributing factors: {factors}{missing}
+
+    Worst forecast UAQI: **{format_peak(exposure, 'forecast_min_aqi')}** | Highest forecast apparent temperature: **{format_peak(exposure, 'forecast_max_apparent_temperature', 'F')}**"""
+
+# Record the browser's viewport width, which sets how many points the figures draw
+clientside_callback(
+    "function(href) { return window.innerWidth; }",
+    Output('viewport-width', 'data'),
+    Input('url', 'href')
+)
+
+def environment_error(message):
+    # The environment stage's outputs when it fails: the message in place of the risk score, leaving the figures empty and the consultation stage untriggered
+    return dash.no_update, dash.no_update, message, dash.no_update
+
+@callback(
+    Output('aqi-graph', 'figure'),
+    Output('temperature-graph', 'figure'),
+    Output('risk-score', 'children'),
+    Output('environment-key', 'data'),
+    Input('records-key', 'data'),
+    State('viewport-width', 'data'),
+    prevent_initial_call=True
+)
+def handle_environment_callback(key, viewport_width):
+    # Stage 2: map coordinates, environmental data and figures
+    data = get_page_data(key, 'records')
+
+    # Use the environmental data prefetched when the launch was authorized, if it was retrieved by this process
+    with page_data_lock:
+        prefetched_future = prefetched_environments.pop(key, None)
+    prefetched_environment = None
+    if prefetched_future:
+        try:
+            with span('environment_data', 'prefetched'):
+                prefetched_environment = prefetched_future.result(timeout=float(os.getenv('ENVIRONMENT_FETCH_TIMEOUT', 15)))
+            app.logger.info("Using the prefetched environmental data")
+        except Exception as e:
+            app.logger.warning(f"Could not prefetch the environmental data, retrieving it again: {e!r}")
+
+    if prefetched_environment:
+        current_dt, environment_store, weather_current_time = prefetched_environment
+    else:
+        # Retrieve latitude + longitude of patient's address
+        try:
+            latitude, longitude = geocode_address(data['patient'], data['address'])
+        except Exception:
+            app.logger.error("An error occurred while geocoding the patient's address", exc_info=True)
+            return environment_error("⚠️ Could not locate the patient's address, so no environmental data or consultation is available.")
+
+        # Generate environmental data and figures
+        current_dt = datetime.now(timezone.utc)
+        try:
+            with span('environment_data'):
+                environment_store, weather_current_time = fetch_environmental_data(current_dt, latitude, longitude)
+        except Exception:
+            app.logger.error("An error occurred while retrieving the patient's environmental data", exc_info=True)
+            return environment_error("⚠️ Could not retrieve the environmental data, so no risk score or consultation is available.")
+    # Only the figures' data, downsampled to the viewport, is sent; their layout was sent once with the page
+    max_points = get_point_budget(viewport_width)
+    with span('figures'):
+        aqi_figure = patch_aqi_figure(current_dt, environment_store, max_points)
+        weather_figure = patch_weather_figure(environment_store, weather_current_time, max_points)
+
+    # Score the patient's risk locally, so it shows while the consultation is generated
+    try:
+        with span('risk_score'):
+            exposure = summarize_exposure(environment_store, current_dt)
+            risk_score = format_risk(assess_risk(data['birth_date'], data['conditions'], data['medication_administrations'], exposure, current_dt, unavailable=data['fetch_errors']), exposure)
+    except Exception:
+        app.logger.error("An error occurred while scoring the patient's risk", exc_info=True)
+        risk_score = "⚠️ Could not compute the risk score"
+
+    save_page_data(key, 'environment', {'current_dt': current_dt, 'weather_current_time': weather_current_time, 'environment_store': environment_store})
+
+    # Render the AQI and temperature visualizations and the risk score
+    return aqi_figure, weather_figure, risk_score, key
+
+@callback(
+    Output('aqi-graph', 'figure', allow_duplicate=True),
+    Input('aqi-graph', 'relayoutData'),
+    State('environment-key', 'data'),
+    State('viewport-width', 'data'),
+    prevent_initial_call=True
+)
+def handle_aqi_zoom_callback(relayout_data, key, viewport_width):
+    # Redraw the AQI traces at the zoomed window's resolution, or the whole history when the zoom is reset
+    zoom_window = get_zoom_window(relayout_data)
+    if zoom_window is None:
+        raise PreventUpdate
+    data = get_page_data(key, 'environment')
+    return patch_aqi_traces(Patch(), data['current_dt'], data['environment_store'], get_point_budget(viewport_width), *zoom_window)
+
+@callback(
+    Output('temperature-graph', 'figure', allow_duplicate=True),
+    Input('temperature-graph', 'relayoutData'),
+    State('environment-key', 'data'),
+    State('viewport-width', 'data'),
+    prevent_initial_call=True
+)
+def handle_temperature_zoom_callback(relayout_data, key, viewport_width):
+    # Redraw the temperature traces at the zoomed window's resolution, or the whole history when the zoom is reset
+    zoom_window = get_zoom_window(relayout_data)
+    if zoom_window is None:
+        raise PreventUpdate
+    data = get_page_data(key, 'environment')
+    return patch_weather_traces(Patch(), data['weather_current_time'], data['environment_store'], get_point_budget(viewport_width), *zoom_window)
+
+@callback(
+    Output('gemini-response', 'children'),
+    Output('consultation-interval', 'disabled'),
+    Input('environment-key', 'data'),
+    prevent_initial_call=True
+)
+def handle_consultation_callback(key):
+    # Stage 3: AI consultation
+    data = {**get_page_data(key, 'records'), **get_page_data(key, 'environment')}
+    patient = data['patient']
+
+    # Ask google gemini to make a recommendation for the patient, given their age, sex, health records, and AQI forecast.
+    model = genai.GenerativeModel(os.getenv('GOOGLE_GEMINI_MODEL'))
+
+    # Serve a cached consultation if the records and the hour-bucketed environment haven't changed
+    with span('environment_summary'):
+        environmental_summary = summarize_environmental_data(data['environment_store'], data['current_dt'].replace(minute=0, second=0, microsecond=0))
+    fingerprint = fingerprint_consultation_inputs(
+        os.getenv('GOOGLE_GEMINI_MODEL'),
+        patient,
+        data['conditions'],
+        data['encounters'],
+        data['medication_administrations'],
+        environmental_summary,
+        unavailable=data['fetch_errors']
+    )
+    cached = consultation_cache.get(fingerprint)
+    increment('consultation_cache_total', result='hit' if cached else 'miss')
+    app.logger.info(f"Consultation cache {'hit' if cached else 'miss'} (hits: {consultation_cache.hits}, misses: {consultation_cache.misses})")
+    if cached:
+        return f"_Generated at {cached['generated_at']}_\n\n{cached['text']}", True
+
+    with span('prompt_build'):
+        clinical_summary, clinical_summary_tokens = build_clinical_summary(data['conditions'], data['encounters'], data['medication_administrations'], unavailable=data['fetch_errors'])
+        prompt = generate_prompt(
+            patient.gender,
+            patient.birthDate.isostring,
+            clinical_summary['health_conditions'],
+            clinical_summary['encounters'],
+            clinical_summary['medication_administrations'],
+            data['current_dt'].strftime(format='%Y-%m-%dT%H:%M:%SZ'),
+            environmental_summary
+        )
+    prompt_tokens = estimate_tokens(prompt)
+    observe('prompt_tokens', prompt_tokens, buckets=TOKEN_BUCKETS)
+    app.logger.info(f"Prompt size: ~{prompt_tokens} tokens, of which ~{clinical_summary_tokens} are clinical records")
+
+    if not GEMINI_STREAMING:
+        with span('gemini_generate'):
+            gemini_response = model.generate_content(prompt)
+        count_gemini_tokens(gemini_response)
+        cache_consultation(fingerprint, gemini_response.text)
+        return gemini_response.text, True
+
+    # Generate in the background and let the interval callback push partial output to the page
+    save_consultation(key, '')
+    consultation_executor.submit(stream_consultation, model, prompt, key, fingerprint)
+    return "_Generating consultation..._", False
+
+@callback(
+    Output('gemini-response', 'children', allow_duplicate=True),
+    Output('consultation-interval', 'disabled', allow_duplicate=True),
+    Input('consultation-interval', 'n_intervals'),
+    State('environment-key', 'data'),
+    prevent_initial_call=True
+)
+def handle_consultation_stream_callback(n_intervals, key):
+    # Push the consultation generated so far, and stop polling once it is complete
+    consultation = page_store.get(f"{key}:consultation") if key else None
+    if consultation is None:
+        # The page load's data has expired, so stop polling
+        return "⚠️ This consultation has expired. Reload the page to generate a new one.", True
+    text, done, error = consultation['text'], consultation['done'], consultation['error']
+    if error:
+        text += "\n\n⚠️ Something went wrong generating the rest of this consultation."
+    elif not text and not done:
+        raise PreventUpdate("No consultation output yet")
+    return text, done
@@ -0,0 +1,51 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, timezone
+from cachetools import TTLCache
+from utils import get_session_smart, fetch_patient_records, get_patient_demographics
+from geocoding import geocode_address
+from environment import fetch_environmental_data
+
+# Start reading the patient's data as soon as the SMART launch is authorized, while the browser is still loading the page
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'true').lower() == 'true'
+prefetch_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PREFETCH_WORKERS', 4)), thread_name_prefix='prefetch')
+
+# Prefetch results waiting to be picked up by the page, keyed by the session's prefetch key
+prefetch_slots = TTLCache(maxsize=int(os.getenv('PREFETCH_MAX_ENTRIES', 256)), ttl=float(os.getenv('PREFETCH_TTL', 120)))
+prefetch_slots_lock = threading.Lock()
+
+def start_prefetch(slot_key, session_id):
+    """
+    Start fetching the launched patient's records, then the environmental data for their
+    address, in the background. The results are put in a slot of two Futures, 'records'
+    (the fetch_patient_records tuple) and 'environment' (the current datetime followed by
+    the fetch_environmental_data tuple), for the page's callbacks to take.
+    """
+    slot = {'records': Future(), 'environment': Future()}
+    with prefetch_slots_lock:
+        prefetch_slots[slot_key] = slot
+    prefetch_executor.submit(prefetch, get_session_smart(session_id), slot)
+
+def take_prefetch(slot_key):
+    # Remove and return the session's prefetch slot, or None if there is none
+    with prefetch_slots_lock:
+        return prefetch_slots.pop(slot_key, None) if slot_key else None
+
+def prefetch(smart, slot):
+    try:
+        records = fetch_patient_records(smart)
+    except Exception as e:
+        slot['records'].set_exception(e)
+        slot['environment'].set_exception(e)
+        return
+    slot['records'].set_result(records)
+
+    try:
+        patient = records[0]
+        _, _, _, address = get_patient_demographics(patient)
+        latitude, longitude = geocode_address(patient, address)
+        current_dt = datetime.now(timezone.utc)
+        slot['environment'].set_result((current_dt, *fetch_environmental_data(current_dt, latitude, longitude)))
+    except Exception as e:
+        slot['environment'].set_exception(e)
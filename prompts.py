@@ -0,0 +1,249 @@
+import os
+import math
+import json
+import hashlib
+import pandas as pd
+from utils import resource_to_dict
+from records import get_resource_version
+from exposure import UAQI_THRESHOLDS, UAQI_BANDS, APPARENT_TEMPERATURE_CUTOFF, SMOKE_EXPOSURE_BASELINE, summarize_exposure
+
+# Approximate token budget for the patient's clinical records in the prompt
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 3000))
+
+# Share of the token budget reserved for each section; budget a section doesn't use goes to the others
+SECTION_SHARES = {
+    'health_conditions': 0.4,
+    'medication_administrations': 0.35,
+    'encounters': 0.25,
+}
+
+# Short names for common code systems
+CODE_SYSTEMS = {
+    'http://snomed.info/sct': 'SNOMED',
+    'http://hl7.org/fhir/sid/icd-10-cm': 'ICD-10-CM',
+    'http://hl7.org/fhir/sid/icd-10': 'ICD-10',
+    'http://www.nlm.nih.gov/research/umls/rxnorm': 'RxNorm',
+    'http://loinc.org': 'LOINC',
+}
+
+ACTIVE_CLINICAL_STATUSES = ['active', 'recurrence', 'relapse']
+
+# Shape of the environmental summary: days of daily history and hours of hourly detail around now
+ENVIRONMENT_SUMMARY_DAYS = int(os.getenv('ENVIRONMENT_SUMMARY_DAYS', 14))
+ENVIRONMENT_SUMMARY_HOURS_BEFORE = int(os.getenv('ENVIRONMENT_SUMMARY_HOURS_BEFORE', 6))
+ENVIRONMENT_SUMMARY_HOURS_AFTER = int(os.getenv('ENVIRONMENT_SUMMARY_HOURS_AFTER', 12))
+ENVIRONMENT_SUMMARY_COLUMNS = {'aqi': 'uaqi', 'temperature_2m': 'temp_f', 'apparent_temperature': 'feels_like_f'}
+
+def estimate_tokens(text):
+    # Roughly four characters per token for English text and codes
+    return math.ceil(len(text) / 4)
+
+def format_codes(codes):
+    # Format the (system, code) pairs of a record
+    codes = [f"{CODE_SYSTEMS.get(system, (system or '').rsplit('/', 1)[-1])} {code}".strip() for system, code in codes]
+    return f" [{', '.join(codes)}]" if codes else ""
+
+def summarize_conditions(conditions):
+    # One line per distinct condition and status, active conditions first, then most recent onset first
+    summaries = {}
+    for condition in conditions:
+        key = (condition.name, condition.clinical_status)
+        if key not in summaries or condition.onset > summaries[key]['onset']:
+            summaries[key] = {'codes': format_codes(condition.codes), 'verification_status': condition.verification_status, 'onset': condition.onset}
+
+    ordered = sorted(summaries.items(), key=lambda item: item[1]['onset'], reverse=True)
+    ordered.sort(key=lambda item: item[0][1] not in ACTIVE_CLINICAL_STATUSES)
+    return [
+        f"{name}{summary['codes']}: {clinical_status}, {summary['verification_status']}" + (f", onset {summary['onset']}" if summary['onset'] else "")
+        for (name, clinical_status), summary in ordered
+    ]
+
+def summarize_repeated(items):
+    # Collapse (name, status, codes, date) tuples into one line per name and status, most recent first
+    summaries = {}
+    for name, status, codes, date in items:
+        summary = summaries.setdefault((name, status), {'codes': codes, 'count': 0, 'last': ''})
+        summary['count'] += 1
+        summary['last'] = max(summary['last'], date)
+
+    ordered = sorted(summaries.items(), key=lambda item: item[1]['last'], reverse=True)
+    return [
+        f"{name}{summary['codes']}: {status}, {summary['count']}x" + (f", most recent {summary['last']}" if summary['last'] else "")
+        for (name, status), summary in ordered
+    ]
+
+def summarize_encounters(encounters):
+    return summarize_repeated(
+        (encounter.description, encounter.status, format_codes(encounter.codes), encounter.start)
+        for encounter in encounters
+    )
+
+def summarize_medication_administrations(medication_administrations):
+    return summarize_repeated(
+        (medication_administration.name, medication_administration.status, format_codes(medication_administration.codes), medication_administration.effective)
+        for medication_administration in medication_administrations
+    )
+
+def fit_to_budget(sections, token_budget):
+    """
+    Select lines from each section, in priority order, so that all sections together stay
+    within 'token_budget'. Each section first gets its share of the budget, then any budget
+    left over is handed out to the sections, in order, that still have lines to add.
+    Returns the kept lines and the number of omitted lines per section, and the tokens used.
+    """
+    kept = {name: [] for name in sections}
+    remaining_budget = token_budget
+    for fill_pass in ['share', 'leftover']:
+        for name, lines in sections.items():
+            section_budget = math.floor(SECTION_SHARES[name] * token_budget) if fill_pass == 'share' else remaining_budget
+            used = 0
+            for line in lines[len(kept[name]):]:
+                tokens = estimate_tokens(line) + 1
+                if used + tokens > section_budget or tokens > remaining_budget:
+                    break
+                kept[name].append(line)
+                used += tokens
+                remaining_budget -= tokens
+    omitted = {name: len(lines) - len(kept[name]) for name, lines in sections.items()}
+    return kept, omitted, token_budget - remaining_budget
+
+# Resource type of each clinical summary section
+SECTION_RESOURCE_TYPES = {'health_conditions': 'Condition', 'medication_administrations': 'MedicationAdministration', 'encounters': 'Encounter'}
+
+def build_clinical_summary(conditions, encounters, medication_administrations, token_budget=PROMPT_TOKEN_BUDGET, unavailable=()):
+    """
+    Reduce the patient's FHIR records (see records.py) to compact, de-duplicated lines holding only
+    clinically relevant fields (names, codes, statuses, dates), prioritized and trimmed to
+    the token budget. Sections whose resource type is in 'unavailable' (their fetch failed)
+    say so rather than "None recorded". Returns a dict of formatted sections and the
+    estimated token count.
+    """
+    sections = {
+        'health_conditions': summarize_conditions(conditions),
+        'medication_administrations': summarize_medication_administrations(medication_administrations),
+        'encounters': summarize_encounters(encounters),
+    }
+    kept, omitted, token_count = fit_to_budget(sections, token_budget)
+
+    summary = {}
+    for name, lines in kept.items():
+        if omitted[name]:
+            lines = lines + [f"({omitted[name]} more omitted)"]
+        if SECTION_RESOURCE_TYPES[name] in unavailable:
+            summary[name] = "Unavailable (these records could not be retrieved; do not assume the patient has none)"
+        else:
+            summary[name] = ''.join(f"\n    - {line}" for line in lines) if lines else "None recorded"
+    return summary, token_count
+
+def format_value(value, unit=''):
+    # A rounded metric value, or '-' when it is unknown
+    return '-' if value is None or value != value else f"{value:.0f}{unit}"
+
+def format_peak(exposure, name, unit=''):
+    if exposure[f'{name}_time'] is None:
+        return '-'
+    return f"{format_value(exposure[name], unit)} at {exposure[f'{name}_time']} (in {exposure[f'{name}_hours_ahead']:.0f}h)"
+
+def summarize_exposure_metrics(exposure):
+    # Lines of the exposure metrics (see exposure.summarize_exposure) worth a clinician's attention
+    return [
+        f"Current UAQI: {format_value(exposure['current_aqi'])} (24h mean {format_value(exposure['aqi_mean_24h'])}, 72h mean {format_value(exposure['aqi_mean_72h'])})",
+        f"Cumulative smoke exposure (UAQI points below {SMOKE_EXPOSURE_BASELINE}, summed over hours): past {format_value(exposure['past_smoke_exposure'])}, forecast {format_value(exposure['forecast_smoke_exposure'])}",
+        "Forecast hours per UAQI band: " + ', '.join(f"{band} {exposure[f'forecast_hours_uaqi_{band}']}" for band in UAQI_BANDS),
+        f"Worst forecast UAQI: {format_peak(exposure, 'forecast_min_aqi')}; lowest forecast 24h mean {format_value(exposure['forecast_min_aqi_mean_24h'])}",
+        f"Highest forecast apparent temperature: {format_peak(exposure, 'forecast_max_apparent_temperature', 'F')}",
+        f"Consecutive days with apparent temperature above {APPARENT_TEMPERATURE_CUTOFF:g}F: longest {exposure['longest_heat_streak_days']}, in the forecast {exposure['forecast_heat_streak_days']}",
+    ]
+
+def summarize_environmental_data(environment_store, current_dt):
+    """
+    Reduce the environmental data store (see environment.build_environment_store) to a
+    fixed-size text summary: daily min/mean/max for the last ENVIRONMENT_SUMMARY_DAYS days
+    and the forecast, hourly detail around the current time, counts of hours past the
+    UAQI and apparent temperature thresholds in the past and the forecast, and exposure
+    metrics (see exposure.compute_exposure_metrics).
+    """
+    now = pd.Timestamp(current_dt).tz_convert('UTC')
+
+    # Daily min/mean/max, from ENVIRONMENT_SUMMARY_DAYS ago to the end of the forecast; the store's grid starts at a UTC midnight
+    window = environment_store.slice((now - pd.Timedelta(days=ENVIRONMENT_SUMMARY_DAYS)).floor('D'))
+    statistics = {statistic: window.resample(24, statistic) for statistic in ['min', 'mean', 'max']}
+    daily = pd.DataFrame(
+        {f"{name}_{statistic}": resampled[column] for column, name in ENVIRONMENT_SUMMARY_COLUMNS.items() for statistic, resampled in statistics.items()},
+        index=statistics['mean'].index.strftime('%Y-%m-%d')
+    )
+
+    # Hourly detail around now
+    hourly = environment_store.slice(now - pd.Timedelta(hours=ENVIRONMENT_SUMMARY_HOURS_BEFORE), now + pd.Timedelta(hours=ENVIRONMENT_SUMMARY_HOURS_AFTER))
+    hourly = hourly.to_frame(list(ENVIRONMENT_SUMMARY_COLUMNS)).rename(columns=ENVIRONMENT_SUMMARY_COLUMNS)
+    hourly.index = hourly.index.strftime('%Y-%m-%dT%H:%MZ')
+
+    # Hours past each threshold, before and after now, and the other exposure metrics
+    exposure = summarize_exposure(environment_store, current_dt)
+    threshold_counts = pd.DataFrame({
+        period: {
+            **{f"hours with UAQI below {threshold}": exposure[f'{period}_hours_uaqi_below_{threshold}'] for threshold in UAQI_THRESHOLDS},
+            f"hours with apparent temperature above {APPARENT_TEMPERATURE_CUTOFF:g}F": exposure[f'{period}_hours_apparent_temperature_above_{APPARENT_TEMPERATURE_CUTOFF:g}'],
+        }
+        for period in ['past', 'forecast']
+    })
+    exposure_metrics = ''.join(f"\n- {line}" for line in summarize_exposure_metrics(exposure))
+
+    return (
+        f"Daily minimum/mean/maximum (UTC days):\n{daily.to_string(na_rep='-', float_format='{:.0f}'.format)}\n\n"
+        f"Hourly detail around now:\n{hourly.to_string(na_rep='-', float_format='{:.0f}'.format)}\n\n"
+        f"Threshold crossings:\n{threshold_counts.to_string()}\n\n"
+        f"Exposure metrics:{exposure_metrics}"
+    )
+
+def fingerprint_consultation_inputs(model_name, patient, conditions, encounters, medication_administrations, environmental_summary, unavailable=()):
+    """
+    A stable hash of everything a consultation depends on: the model, the id and version of
+    the Patient and each of its records, the resource types that could not be retrieved,
+    and the (hour-bucketed) environmental summary.
+    """
+    patient = resource_to_dict(patient)
+    fingerprint = {
+        'model': model_name,
+        'patient': ['Patient', patient.get('id'), get_resource_version(patient)],
+        'resources': sorted([record.resource_type, record.id, record.version] for record in [*conditions, *encounters, *medication_administrations]),
+        'environment': environmental_summary,
+        'unavailable': sorted(unavailable),
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode()).hexdigest()
+
+def generate_prompt(sex, date_of_birth, health_conditions, encounters, medication_administrations, current_dt, combined_environmental_data):
+    return f""""
+    -------------------------------
+    Prompt Context
+
+    You have been approached by a healthcare professional seeking consultation on how to mitigate the health risks or treat the health complications 
+    associated with climate-related events, such as heat waves or forest fires. Your role as the AI specialist is to provide a consultation based on 
+    the specific characteristics and surrounding environment of the patient, like their demographics, health conditions, medications, encounter history, Universal AQI, 
+    temperature, and apparent temperature.
+    -------------------------------
+    Patient Details
+
+    Sex: {sex}
+    Date of Birth: {date_of_birth}
+    Health Conditions: {health_conditions}
+    Encounters: {encounters}
+    Medication Administrations: {medication_administrations}
+
+    Here is a summary of the past, present, and forecasted environmental data for the patient's primary address. It includes daily minimum, mean and maximum 
+    universal air quality index measurements (uaqi), temperature (temp_f, Fahrenheit), and apparent temperature (feels_like_f, Fahrenheit), 
+    hourly detail around the current datetime, and counts of past and forecasted hours beyond clinically relevant thresholds. Right now, The current datetime is {current_dt}.
+    Please note that the UAQI data and temperature data may not perfectly overlap in time, as they are collected from different sources. Values shown as '-' 
+    should not be considered as missing data, but rather as the absence of data.
+
+    Furthermore, here is the scale for the Universal AQI (UAQI) values:
+    100 - 80 = "Excellent air quality"
+    79 - 60	= "Good air quality"
+    59 - 40	= "Moderate air quality"
+    39 - 20	= "Low air quality"
+    19 - 0 = "Poor air quality"
+    
+    {combined_environmental_data}
+
+    -------------------------------
+    """
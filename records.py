@@ -0,0 +1,146 @@
+def get_codeable_concept_name(codeable_concept):
+    # Prefer the concept's text, falling back to the first coding with a display
+    if 'text' in codeable_concept:
+        return codeable_concept['text']
+    for coding in codeable_concept.get('coding', []):
+        if 'display' in coding:
+            return coding['display']
+    return ''
+
+def get_condition_name(condition):
+    if 'code' in condition and condition['code']:
+        return get_codeable_concept_name(condition['code'])
+    return ''
+
+def get_encounter_description(encounter):
+    encounter_description = ''
+    if 'serviceType' in encounter and encounter['serviceType']:
+        encounter_description = get_codeable_concept_name(encounter['serviceType'])
+    elif 'type' in encounter and encounter['type']:
+        for codeable_concept in encounter['type']:
+            encounter_description = get_codeable_concept_name(codeable_concept) or encounter_description
+    elif 'class' in encounter and encounter['class']:
+        encounter_class = encounter['class']
+        if 'display' in encounter_class:
+            encounter_description = encounter_class['display']
+    else:
+        raise Exception("An Encounter resource has no human-readable element to serve as a description")
+    return encounter_description
+
+def get_medication_administration_name(medication_administration):
+    if 'medicationCodeableConcept' in medication_administration and medication_administration['medicationCodeableConcept']:
+        return get_codeable_concept_name(medication_administration['medicationCodeableConcept'])
+    elif 'medicationReference' in medication_administration and medication_administration['medicationReference']:
+        return medication_administration['medicationReference'].get('display', '')
+    else:
+        raise Exception("A medication resource has no human-readable 'medication[x]' element")
+
+def get_status_code(codeable_concept):
+    return codeable_concept['coding'][0]['code'] if codeable_concept and codeable_concept.get('coding') else 'Unknown'
+
+def get_codes(codeable_concept):
+    # (system, code) pairs of a CodeableConcept
+    return tuple((coding.get('system'), coding['code']) for coding in (codeable_concept or {}).get('coding', []) if 'code' in coding)
+
+def get_resource_version(resource):
+    meta = resource.get('meta', {})
+    return meta.get('versionId') or meta.get('lastUpdated')
+
+class ConditionRecord:
+    """
+    The fields of a Condition used by the tables, the prompt and the consultation cache,
+    read straight from the resource's JSON.
+    """
+    __slots__ = ('id', 'version', 'name', 'clinical_status', 'verification_status', 'codes', 'onset')
+    resource_type = 'Condition'
+
+    def __init__(self, id, version, name, clinical_status, verification_status, codes, onset):
+        self.id = id
+        self.version = version
+        self.name = name
+        self.clinical_status = clinical_status
+        self.verification_status = verification_status
+        self.codes = codes
+        self.onset = onset
+
+    @classmethod
+    def from_json(cls, condition):
+        return cls(
+            condition.get('id'),
+            get_resource_version(condition),
+            get_condition_name(condition),
+            get_status_code(condition.get('clinicalStatus')),
+            get_status_code(condition.get('verificationStatus')),
+            get_codes(condition.get('code')),
+            (condition.get('onsetDateTime') or condition.get('onsetPeriod', {}).get('start') or condition.get('recordedDate') or '')[:10]
+        )
+
+class EncounterRecord:
+    """
+    The fields of an Encounter used by the tables, the prompt and the consultation cache,
+    read straight from the resource's JSON.
+    """
+    __slots__ = ('id', 'version', 'description', 'status', 'codes', 'start')
+    resource_type = 'Encounter'
+
+    def __init__(self, id, version, description, status, codes, start):
+        self.id = id
+        self.version = version
+        self.description = description
+        self.status = status
+        self.codes = codes
+        self.start = start
+
+    @classmethod
+    def from_json(cls, encounter):
+        return cls(
+            encounter.get('id'),
+            get_resource_version(encounter),
+            get_encounter_description(encounter),
+            encounter.get('status', 'Unknown'),
+            get_codes(encounter['type'][0]) if encounter.get('type') else (),
+            (encounter.get('period', {}).get('start') or '')[:10]
+        )
+
+class MedicationAdministrationRecord:
+    """
+    The fields of a MedicationAdministration used by the tables, the prompt and the
+    consultation cache, read straight from the resource's JSON.
+    """
+    __slots__ = ('id', 'version', 'name', 'status', 'codes', 'effective')
+    resource_type = 'MedicationAdministration'
+
+    def __init__(self, id, version, name, status, codes, effective):
+        self.id = id
+        self.version = version
+        self.name = name
+        self.status = status
+        self.codes = codes
+        self.effective = effective
+
+    @classmethod
+    def from_json(cls, medication_administration):
+        return cls(
+            medication_administration.get('id'),
+            get_resource_version(medication_administration),
+            get_medication_administration_name(medication_administration),
+            medication_administration.get('status', 'Unknown'),
+            get_codes(medication_administration.get('medicationCodeableConcept')),
+            (medication_administration.get('effectiveDateTime') or medication_administration.get('effectivePeriod', {}).get('start') or '')[:10]
+        )
+
+# Record class for each resource type the app reads
+RECORD_TYPES = {record_type.resource_type: record_type for record_type in [ConditionRecord, EncounterRecord, MedicationAdministrationRecord]}
+
+def dump_records(records):
+    # Records as lists of their field values, to store as JSON
+    return [[getattr(record, field) for field in record.__slots__] for record in records]
+
+def load_records(record_type, rows):
+    # Records of the given type from lists of their field values; JSON turns the (system, code) pairs into lists
+    records = []
+    for row in rows:
+        values = dict(zip(record_type.__slots__, row))
+        values['codes'] = tuple(tuple(code) for code in values['codes'])
+        records.append(record_type(**values))
+    return records
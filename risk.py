@@ -0,0 +1,183 @@
+import os
+import re
+from datetime import date
+from functools import lru_cache
+from prompts import ACTIVE_CLINICAL_STATUSES
+from exposure import UAQI_THRESHOLDS, APPARENT_TEMPERATURE_CUTOFF
+
+# Rule-based smoke and heat risk score, computed locally in milliseconds from the patient's records
+# and environmental data, shown before the AI consultation and used to triage cohort runs
+
+SNOMED = 'http://snomed.info/sct'
+RXNORM = 'http://www.nlm.nih.gov/research/umls/rxnorm'
+ICD_10_SYSTEMS = ['http://hl7.org/fhir/sid/icd-10-cm', 'http://hl7.org/fhir/sid/icd-10']
+
+# Risk factors, their label and points
+RISK_FACTORS = {
+    'asthma': ("Asthma", 3),
+    'copd': ("COPD", 3),
+    'heart_failure': ("Heart failure", 3),
+    'coronary_artery_disease': ("Coronary artery disease", 2),
+    'pregnancy': ("Pregnancy", 2),
+    'diabetes': ("Diabetes", 1),
+    'chronic_kidney_disease': ("Chronic kidney disease", 1),
+    'beta_agonist': ("Beta-agonist inhaler", 2),
+    'inhaled_corticosteroid': ("Inhaled corticosteroid", 1),
+    'inhaled_anticholinergic': ("Inhaled anticholinergic", 1),
+    'diuretic': ("Diuretic", 1),
+    'age_under_5': ("Age under 5", 2),
+    'age_65_to_74': ("Age 65 to 74", 1),
+    'age_75_and_over': ("Age 75 and over", 2),
+}
+
+# Codes of each risk factor: SNOMED concepts, ICD-10 categories (code prefixes) and RxNorm ingredients and products
+RISK_FACTOR_CODES = {
+    'asthma': {SNOMED: ['195967001', '233678006'], 'ICD-10': ['J45']},
+    'copd': {SNOMED: ['13645005', '185086009', '87433001'], 'ICD-10': ['J43', 'J44']},
+    'heart_failure': {SNOMED: ['84114007', '88805009', '42343007'], 'ICD-10': ['I50']},
+    'coronary_artery_disease': {SNOMED: ['53741008', '414545008', '22298006'], 'ICD-10': ['I20', 'I21', 'I25']},
+    'pregnancy': {SNOMED: ['77386006', '72892002'], 'ICD-10': ['O', 'Z33', 'Z34']},
+    'diabetes': {SNOMED: ['44054006', '46635009', '73211009'], 'ICD-10': ['E10', 'E11']},
+    'chronic_kidney_disease': {SNOMED: ['709044004', '433144002'], 'ICD-10': ['N18']},
+    'beta_agonist': {RXNORM: ['435', '237159', '36117', '25255', '745679', '2123111']},
+    'inhaled_corticosteroid': {RXNORM: ['41126', '19831', '895994']},
+    'inhaled_anticholinergic': {RXNORM: ['7213', '69120']},
+    'diuretic': {RXNORM: ['4603', '5487']},
+}
+
+# Name patterns of each risk factor, for records coded in other systems or not coded at all
+RISK_FACTOR_NAMES = {
+    'asthma': r'\basthma',
+    'copd': r'\bcopd\b|chronic obstructive|\bemphysema',
+    'heart_failure': r'heart failure',
+    'coronary_artery_disease': r'\bcoronary|ischemic heart|myocardial infarction',
+    'pregnancy': r'\bpregnan',
+    'diabetes': r'\bdiabetes',
+    'chronic_kidney_disease': r'chronic kidney disease',
+    'beta_agonist': r'albuterol|salbutamol|salmeterol|formoterol',
+    'inhaled_corticosteroid': r'fluticasone|budesonide|beclomethasone|mometasone',
+    'inhaled_anticholinergic': r'ipratropium|tiotropium',
+    'diuretic': r'furosemide|hydrochlorothiazide|bumetanide|torsemide',
+}
+
+# Lookup indexes built once: (system, code) pairs and ICD-10 category prefixes to risk factors
+RISK_CODE_INDEX = {
+    (system, code): factor
+    for factor, systems in RISK_FACTOR_CODES.items()
+    for system, codes in systems.items() if system != 'ICD-10'
+    for code in codes
+}
+ICD_10_PREFIX_INDEX = {prefix: factor for factor, systems in RISK_FACTOR_CODES.items() for prefix in systems.get('ICD-10', [])}
+RISK_NAME_PATTERNS = [(re.compile(pattern, re.IGNORECASE), factor) for factor, pattern in RISK_FACTOR_NAMES.items()]
+
+# Statuses of records that don't count as evidence of a risk factor
+EXCLUDED_VERIFICATION_STATUSES = ['refuted', 'entered-in-error']
+EXCLUDED_MEDICATION_STATUSES = ['not-done', 'entered-in-error']
+
+# Risk levels, from lowest to highest, and the lowest level that calls for an AI consultation in bulk workflows
+RISK_LEVELS = ['low', 'moderate', 'high']
+RISK_CONSULT_LEVEL = os.getenv('RISK_CONSULT_LEVEL', 'moderate')
+
+def match_codes(codes):
+    # Risk factors of a record's (system, code) pairs
+    factors = set()
+    for system, code in codes:
+        if (system, code) in RISK_CODE_INDEX:
+            factors.add(RISK_CODE_INDEX[(system, code)])
+        elif system in ICD_10_SYSTEMS:
+            for prefix in (code[:3], code[:1]):
+                if prefix in ICD_10_PREFIX_INDEX:
+                    factors.add(ICD_10_PREFIX_INDEX[prefix])
+    return factors
+
+@lru_cache(maxsize=4096)
+def match_name(name):
+    # Risk factors named in a record's display text; record names repeat a lot, so they are memoized
+    return frozenset(factor for pattern, factor in RISK_NAME_PATTERNS if pattern.search(name))
+
+def get_age(birth_date, on_date):
+    # Age in whole years from an ISO 8601 date, year-month or year, or None if it is unknown
+    try:
+        born = date(*([int(part) for part in birth_date.split('-')] + [1, 1])[:3])
+    except (AttributeError, ValueError, TypeError):
+        return None
+    return on_date.year - born.year - ((on_date.month, on_date.day) < (born.month, born.day))
+
+def get_age_factor(age):
+    if age is None:
+        return None
+    if age < 5:
+        return 'age_under_5'
+    if age >= 75:
+        return 'age_75_and_over'
+    if age >= 65:
+        return 'age_65_to_74'
+    return None
+
+def find_risk_factors(birth_date, conditions, medication_administrations, current_dt):
+    """
+    The patient's risk factors: active conditions and administered medications matched by
+    code (see RISK_FACTOR_CODES), or by name when none of their codes are indexed, and age.
+    """
+    factors = set()
+    for condition in conditions:
+        if condition.clinical_status not in ACTIVE_CLINICAL_STATUSES + ['Unknown'] or condition.verification_status in EXCLUDED_VERIFICATION_STATUSES:
+            continue
+        factors |= match_codes(condition.codes) or match_name(condition.name)
+    for medication_administration in medication_administrations:
+        if medication_administration.status in EXCLUDED_MEDICATION_STATUSES:
+            continue
+        factors |= match_codes(medication_administration.codes) or match_name(medication_administration.name)
+    age_factor = get_age_factor(get_age(birth_date, current_dt))
+    if age_factor:
+        factors.add(age_factor)
+    return factors
+
+def score_exposure(exposure):
+    # Exposure points and their reasons: smoke from the current and forecast UAQI, heat from forecast apparent temperature
+    moderate_threshold, poor_threshold = UAQI_THRESHOLDS
+    reasons = []
+    if exposure[f'forecast_hours_uaqi_below_{poor_threshold}']:
+        reasons.append((f"{exposure[f'forecast_hours_uaqi_below_{poor_threshold}']} forecast hours of UAQI below {poor_threshold}", 3))
+    elif exposure[f'forecast_hours_uaqi_below_{moderate_threshold}']:
+        reasons.append((f"{exposure[f'forecast_hours_uaqi_below_{moderate_threshold}']} forecast hours of UAQI below {moderate_threshold}", 2))
+    elif exposure['current_aqi'] < moderate_threshold:
+        reasons.append((f"Current UAQI {exposure['current_aqi']:.0f}", 1))
+    hot_hours = exposure[f'forecast_hours_apparent_temperature_above_{APPARENT_TEMPERATURE_CUTOFF:g}']
+    if hot_hours:
+        reasons.append((f"{hot_hours} forecast hours of apparent temperature above {APPARENT_TEMPERATURE_CUTOFF:g}F", 3 if hot_hours >= 6 else 2))
+    return reasons
+
+def get_risk_level(vulnerability, exposure):
+    # High when a vulnerable patient faces a forecast hazard; moderate for either a forecast hazard or a vulnerable patient with some exposure
+    if exposure >= 2 and vulnerability >= 3:
+        return 'high'
+    if exposure >= 2 or (exposure >= 1 and vulnerability >= 3):
+        return 'moderate'
+    return 'low'
+
+def assess_risk(birth_date, conditions, medication_administrations, exposure, current_dt, unavailable=()):
+    """
+    Score the patient's smoke and heat risk from their risk factors (vulnerability points) and
+    their environmental exposure (exposure points), given the exposure metrics of their
+    location (see exposure.summarize_exposure). Returns a dict of the score (the sum of
+    both), the risk level, whether it calls for an AI consultation, the contributing
+    factors as (label, points) pairs, highest first, and the resource types the score is
+    missing. Conditions or medication administrations listed in 'unavailable' (their fetch
+    failed) make the score a lower bound, so the patient is always flagged for a consultation.
+    """
+    missing = [resource_type for resource_type in ['Condition', 'MedicationAdministration'] if resource_type in unavailable]
+    factors = [RISK_FACTORS[factor] for factor in find_risk_factors(birth_date, conditions, medication_administrations, current_dt)]
+    exposure_reasons = score_exposure(exposure)
+    vulnerability_points = sum(points for _, points in factors)
+    exposure_points = sum(points for _, points in exposure_reasons)
+    level = get_risk_level(vulnerability_points, exposure_points)
+    return {
+        'score': vulnerability_points + exposure_points,
+        'level': level,
+        'needs_consult': bool(missing) or RISK_LEVELS.index(level) >= RISK_LEVELS.index(RISK_CONSULT_LEVEL),
+        'vulnerability': vulnerability_points,
+        'exposure': exposure_points,
+        'factors': sorted(factors + exposure_reasons, key=lambda factor: factor[1], reverse=True),
+        'missing': missing,
+    }
@@ -0,0 +1,173 @@
+"""
+The patient record fetch modes (utils.fetch_patient_records) against an in-memory FHIR
+stand-in: one search per resource type, a batch Bundle, Patient/$everything, and the 'auto'
+mode's choice between them, with every search split over several pages.
+
+Run from the repository root: python -m unittest discover tests
+"""
+import os
+import sys
+import tempfile
+import unittest
+from urllib.parse import parse_qsl, urlsplit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['CACHE_DIR'] = tempfile.mkdtemp()
+import utils
+
+PATIENT = {'resourceType': 'Patient', 'id': 'p1', 'name': [{'family': 'Lee', 'given': ['Ann']}], 'gender': 'female', 'birthDate': '1950-04-02'}
+RESOURCES = {
+    'Condition': [
+        {'resourceType': 'Condition', 'id': f'c{i}', 'meta': {'versionId': '1'}, 'code': {'coding': [{'system': 'http://snomed.info/sct', 'code': '195967001', 'display': 'Asthma'}]}}
+        for i in range(5)
+    ],
+    'MedicationAdministration': [
+        {'resourceType': 'MedicationAdministration', 'id': f'm{i}', 'status': 'completed', 'medicationCodeableConcept': {'text': 'Albuterol'}}
+        for i in range(3)
+    ],
+    'Encounter': [
+        {'resourceType': 'Encounter', 'id': f'e{i}', 'status': 'finished', 'class': {'code': 'AMB', 'display': 'ambulatory'}}
+        for i in range(4)
+    ],
+}
+PAGE_SIZE = 2
+
+class FHIRStandIn:
+    """
+    Answers the requests fhirclient and utils make of a FHIR server: the Patient read,
+    searches and their 'next' pages (PAGE_SIZE resources each), metadata, batch Bundles
+    and Patient/$everything. Records every request it is sent.
+    """
+    def __init__(self, batch=True, everything=True):
+        self.base_uri = 'http://fhir.test/'
+        self.batch = batch
+        self.everything = everything
+        self.requests = []
+
+    def searchset(self, source, resources, offset=0):
+        links = []
+        if offset + PAGE_SIZE < len(resources):
+            links.append({'relation': 'next', 'url': f"{self.base_uri}page?source={source}&offset={offset + PAGE_SIZE}"})
+        return {'resourceType': 'Bundle', 'type': 'searchset', 'link': links, 'entry': [{'resource': resource} for resource in resources[offset:offset + PAGE_SIZE]]}
+
+    def everything_resources(self):
+        return [PATIENT, *(resource for resources in RESOURCES.values() for resource in resources)]
+
+    def request_json(self, path):
+        self.requests.append(('GET', path))
+        url = urlsplit(path)
+        # 'next' links are absolute URLs on the server's base
+        path = url.path.lstrip('/') if url.netloc else url.path
+        query = dict(parse_qsl(url.query))
+        if path == 'metadata':
+            operations = [{'name': 'everything'}] if self.everything else []
+            return {'resourceType': 'CapabilityStatement', 'rest': [{
+                'interaction': [{'code': 'batch'}] if self.batch else [],
+                'resource': [{'type': 'Patient', 'operation': operations}],
+            }]}
+        if path == 'Patient/p1':
+            return PATIENT
+        if path == 'Patient/p1/$everything':
+            return self.searchset('everything', self.everything_resources())
+        if path == 'page':
+            resources = self.everything_resources() if query['source'] == 'everything' else RESOURCES[query['source']]
+            return self.searchset(query['source'], resources, int(query['offset']))
+        return self.searchset(path, RESOURCES[path])
+
+    def post_json(self, path, resource):
+        self.requests.append(('POST', path))
+        entries = []
+        for entry in resource['entry']:
+            url = entry['request']['url']
+            if url == 'Patient/p1':
+                entries.append({'resource': PATIENT, 'response': {'status': '200 OK'}})
+            elif url.split('?')[0] == 'Encounter':
+                # A search the server refuses, which must not fail the others
+                entries.append({'response': {'status': '403 Forbidden'}})
+            else:
+                entries.append({'resource': self.searchset(url.split('?')[0], RESOURCES[url.split('?')[0]]), 'response': {'status': '200 OK'}})
+        return FakeResponse({'resourceType': 'Bundle', 'type': 'batch-response', 'entry': entries})
+
+class FakeResponse:
+    def __init__(self, json):
+        self._json = json
+
+    def json(self):
+        return self._json
+
+class FakeSmart:
+    def __init__(self, server):
+        self.server = server
+        self.patient_id = 'p1'
+
+class FetchModeTests(unittest.TestCase):
+    def setUp(self):
+        utils.server_capabilities.clear()
+        self.fetch_mode = utils.FHIR_FETCH_MODE
+
+    def tearDown(self):
+        utils.FHIR_FETCH_MODE = self.fetch_mode
+
+    def fetch(self, fetch_mode, server):
+        utils.FHIR_FETCH_MODE = fetch_mode
+        return utils.fetch_patient_records(FakeSmart(server))
+
+    def assert_records(self, records, resource_types=('Condition', 'MedicationAdministration', 'Encounter')):
+        patient, conditions, medication_administrations, encounters, _ = records
+        self.assertEqual(patient.id, 'p1')
+        for resource_type, fetched in zip(['Condition', 'MedicationAdministration', 'Encounter'], [conditions, medication_administrations, encounters]):
+            expected = [resource['id'] for resource in RESOURCES[resource_type]] if resource_type in resource_types else []
+            self.assertEqual(sorted(record.id for record in fetched), sorted(expected), resource_type)
+
+    def page_requests(self, server):
+        return [path for method, path in server.requests if '/page?' in path]
+
+    def test_search_follows_every_page(self):
+        server = FHIRStandIn()
+        records = self.fetch('search', server)
+        self.assert_records(records)
+        self.assertEqual(records[4], {})
+        # 5 Conditions, 3 MedicationAdministrations and 4 Encounters, 2 per page: 2 + 1 + 1 more pages
+        self.assertEqual(len(self.page_requests(server)), 4)
+        self.assertNotIn('POST', [method for method, _ in server.requests])
+
+    def test_batch_follows_pages_and_reports_failed_entries(self):
+        server = FHIRStandIn()
+        records = self.fetch('batch', server)
+        self.assert_records(records, resource_types=('Condition', 'MedicationAdministration'))
+        self.assertEqual(list(records[4]), ['Encounter'])
+        self.assertEqual([method for method, path in server.requests if '/page?' not in path], ['POST'])
+        self.assertEqual(len(self.page_requests(server)), 3)
+
+    def test_everything_follows_every_page(self):
+        server = FHIRStandIn()
+        records = self.fetch('everything', server)
+        self.assert_records(records)
+        self.assertEqual(records[4], {})
+        self.assertTrue(server.requests[0][1].startswith('Patient/p1/$everything?_type=Patient,Condition,MedicationAdministration,Encounter'))
+        # The Patient and 12 records, 2 per page
+        self.assertEqual(len(self.page_requests(server)), 6)
+
+    def test_auto_prefers_batch(self):
+        server = FHIRStandIn(batch=True, everything=True)
+        self.fetch('auto', server)
+        self.assertEqual([path for _, path in server.requests][:2], ['metadata', ''])
+
+    def test_auto_uses_everything_without_batch(self):
+        server = FHIRStandIn(batch=False, everything=True)
+        self.assert_records(self.fetch('auto', server))
+        self.assertTrue(server.requests[1][1].startswith('Patient/p1/$everything'))
+
+    def test_auto_falls_back_to_search(self):
+        server = FHIRStandIn(batch=False, everything=False)
+        self.assert_records(self.fetch('auto', server))
+        searched = {path.split('?')[0] for _, path in server.requests if '?patient=' in path}
+        self.assertEqual(searched, {'Condition', 'MedicationAdministration', 'Encounter'})
+
+    def test_capabilities_are_read_once_per_server(self):
+        server = FHIRStandIn(batch=False, everything=False)
+        self.fetch('auto', server)
+        self.fetch('auto', server)
+        self.assertEqual([path for _, path in server.requests].count('metadata'), 1)
+
+if __name__ == '__main__':
+    unittest.main()
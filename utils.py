@@ -1,8 +1,20 @@
 from flask import session
 from fhirclient import client
 from fhirclient.models.condition import Condition
-from fhirclient.models.bundle import Bundle
+from fhirclient.models.patient import Patient
+from fhirclient.models.encounter import Encounter
+from fhirclient.models.medicationadministration import MedicationAdministration
+from concurrent.futures import ThreadPoolExecutor, wait
+from http_client import session as http_session
+from records import RECORD_TYPES
+from cache import SQLiteCache
+from metrics import span, in_current_context
+from cachetools import TTLCache
+from datetime import date, timedelta
 import os
+import queue
+import threading
+import uuid
 import urllib.parse
 from dash import dash_table
 import json
@@ -15,58 +27,133 @@ app_settings = {
     'redirect_uri': os.getenv('REDIRECT_URI'),
     'scope': os.getenv('SCOPE')
 }
-def save_state(state):
-    session['state'] = state
+
+# Per-resource-type FHIR search profiles: a large page size, only the elements records.py reads (meta carries
+# the version the consultation cache keys on), newest first, and an optional lookback window in years on a date parameter
+FHIR_SEARCH_PROFILES_ENABLED = os.getenv('FHIR_SEARCH_PROFILES_ENABLED', 'true').lower() == 'true'
+FHIR_PAGE_SIZE = os.getenv('FHIR_PAGE_SIZE', '200')
+FHIR_SEARCH_PROFILES = {
+    'Condition': {
+        'params': {
+            '_count': FHIR_PAGE_SIZE,
+            '_elements': 'meta,code,clinicalStatus,verificationStatus,onsetDateTime,onsetPeriod,recordedDate',
+            '_sort': '-recorded-date',
+        },
+        'date_param': 'recorded-date',
+        'lookback_years': os.getenv('CONDITION_LOOKBACK_YEARS'),
+    },
+    'MedicationAdministration': {
+        'params': {
+            '_count': FHIR_PAGE_SIZE,
+            '_elements': 'meta,status,medicationCodeableConcept,medicationReference,effectiveDateTime,effectivePeriod',
+            '_sort': '-effective-time',
+        },
+        'date_param': 'effective-time',
+        'lookback_years': os.getenv('MEDICATION_ADMINISTRATION_LOOKBACK_YEARS'),
+    },
+    'Encounter': {
+        'params': {
+            '_count': FHIR_PAGE_SIZE,
+            '_elements': 'meta,status,class,type,serviceType,period',
+            '_sort': '-date',
+        },
+        'date_param': 'date',
+        'lookback_years': os.getenv('ENCOUNTER_LOOKBACK_YEARS'),
+    },
+}
+
+# How the patient's records are fetched: 'search' (one search per resource type), 'batch' (one batch
+# Bundle), 'everything' (Patient/$everything), or 'auto' (batch or $everything, if the server supports them)
+FHIR_FETCH_MODE = os.getenv('FHIR_FETCH_MODE', 'search').lower()
+
+# Server capabilities relevant to the fetch modes, keyed by FHIR base URI
+server_capabilities = {}
+
+# Most resources a paged search may hold in memory ahead of its consumer
+FHIR_MAX_BUFFERED_RESOURCES = int(os.getenv('FHIR_MAX_BUFFERED_RESOURCES', 1000))
+
+# Bounded worker pool shared by all concurrent FHIR reads
+fhir_executor = ThreadPoolExecutor(max_workers=int(os.getenv('FHIR_FETCH_WORKERS', 4)), thread_name_prefix='fhir-fetch')
+
+# SMART client state, kept server-side by session id so every thread and worker process sees the same state;
+# only the session id is stored in the session cookie
+smart_sessions = SQLiteCache(
+    'sessions.sqlite3',
+    'smart_sessions',
+    ttl=float(os.getenv('SMART_SESSION_TTL', 8 * 3600)),
+    max_entries=int(os.getenv('SMART_SESSION_MAX_ENTRIES', 10000))
+)
+
+# Authenticated FHIR clients reused within a session by this process, with the state they were built from
+smart_clients = TTLCache(maxsize=int(os.getenv('SMART_CLIENT_MAX_ENTRIES', 256)), ttl=float(os.getenv('SMART_CLIENT_TTL', 900)))
+smart_clients_lock = threading.Lock()
+
+def get_session_id():
+    # The current session's id, created on first use
+    if 'sid' not in session:
+        session['sid'] = str(uuid.uuid4())
+    return session['sid']
+
+def save_state(session_id, state):
+    smart_sessions.set(session_id, state)
 
 def reset():
-    if 'state' in session:
-        del session['state']
+    # Forget the current session's SMART state and start a new session id
+    session_id = session.pop('sid', None)
+    if session_id:
+        smart_sessions.delete(session_id)
+        with smart_clients_lock:
+            smart_clients.pop(session_id, None)
 
 # Function to get FHIR client
-def get_smart():
-    state = session.get('state')
+def get_smart(launch_token=None):
+    return get_session_smart(get_session_id(), launch_token)
+
+def get_session_smart(session_id, launch_token=None):
+    """
+    Return the FHIR client of the given session, built from its stored state or, for a
+    new session, from app_settings plus the launch token. The client of a session is
+    reused for as long as its stored state hasn't changed; it saves any new state (e.g.
+    after authorization) back to the session store. Needs no request context.
+    """
+    state = smart_sessions.get(session_id)
+    with smart_clients_lock:
+        cached = smart_clients.get(session_id)
+    if state and cached and cached[0] == state:
+        return cached[1]
+
     if state:
-        return client.FHIRClient(state=state, save_func=save_state)
+        smart = client.FHIRClient(state=state, save_func=lambda state: save_state(session_id, state))
     else:
-        return client.FHIRClient(settings=app_settings, save_func=save_state)
+        smart = client.FHIRClient(settings={**app_settings, 'launch_token': launch_token}, save_func=lambda state: save_state(session_id, state))
+    # Route FHIR requests through the shared pooled session; authorization is sent per request
+    if smart.server:
+        smart.server.session = http_session
+    if state:
+        with smart_clients_lock:
+            smart_clients[session_id] = (state, smart)
+    return smart
+
+def resource_to_dict(resource):
+    # Accept a fhirclient model, its JSON dict, or a JSON string
+    resource_json = resource.as_json() if callable(getattr(resource, 'as_json', None)) else resource
+    return json.loads(resource_json) if isinstance(resource_json, str) else resource_json
 
 def generate_clinical_details_table(conditions, encounters, medication_administrations):
     """
-    A function for processing a list of FHIR resource objects and arranging
-    them in a Dash table. Conditions are processed first, then Encounters, then
-    Medication Administrations.
+    A function for arranging the patient's FHIR records (see records.py) in
+    Dash tables. Conditions are processed first, then
+    Encounters, then Medication Administrations.
     """
     # Define the list to store condition details
     health_conditions_list = []
 
     # Iterate through each condition and collect the necessary details
     for condition in conditions:
-        condition_name = ''
-        condition_json = condition.as_json() if callable(condition.as_json) else condition
-        condition = json.loads(condition_json) if isinstance(condition_json, str) else condition_json
-
-        if 'code' in condition and condition['code']:
-            code = condition['code']
-            if 'text' in code:
-                condition_name = code['text']
-            elif 'coding' in code:
-                for coding in code['coding']:
-                    if 'display' in coding:
-                        condition_name = coding['display']
-                        break
-
-        clinical_status = 'Unknown'
-        if 'clinicalStatus' in condition and condition['clinicalStatus']:
-            clinical_status = condition['clinicalStatus']['coding'][0]['code'] if condition['clinicalStatus']['coding'] else 'Unknown'
-
-        verification_status = 'Unknown'
-        if 'verificationStatus' in condition and condition['verificationStatus']:
-            verification_status = condition['verificationStatus']['coding'][0]['code'] if condition['verificationStatus']['coding'] else 'Unknown'
-
         health_conditions_list.append({
-            'condition_name': condition_name,
-            'clinical_status': clinical_status,
-            'verification_status': verification_status,
+            'condition_name': condition.name,
+            'clinical_status': condition.clinical_status,
+            'verification_status': condition.verification_status,
         })
 
     # Sort conditions by status
@@ -103,39 +190,9 @@ def generate_clinical_details_table(conditions, encounters, medication_administr
 
     # Iterate through each encounter and collect the necessary details
     for encounter in encounters:
-        encounter_description = ''
-        encounter_json = encounter.as_json() if callable(encounter.as_json) else encounter
-        encounter = json.loads(encounter_json) if isinstance(encounter_json, str) else encounter_json
-
-        if 'serviceType' in encounter and encounter['serviceType']:
-            service_type = encounter['serviceType']
-            if 'text' in service_type:
-                encounter_description = service_type['text']
-            elif 'coding' in service_type:
-                for coding in service_type['coding']:
-                    if 'display' in coding:
-                        encounter_description = coding['display']
-                        break
-        elif 'type' in encounter and encounter['type']:
-            for codeable_concept in encounter['type']:
-                if 'text' in codeable_concept:
-                    encounter_description = codeable_concept['text']
-                elif 'coding' in codeable_concept:
-                    for coding in codeable_concept['coding']:
-                        if 'display' in coding:
-                            encounter_description = coding['display']
-                            break
-        elif 'class' in encounter and encounter['class']:
-            encounter_class = encounter['class']
-            if 'display' in encounter_class:
-                encounter_description = encounter_class['display']
-        else:
-            raise Exception("An Encounter resource has no human-readable element to serve as a description")
-
-        encounter_status = encounter.get('status', 'Unknown')
         encounters_list.append({
-            'encounter_description': encounter_description,
-            'encounter_status': encounter_status,
+            'encounter_description': encounter.description,
+            'encounter_status': encounter.status,
         })
 
     # Sort encounters by status
@@ -171,29 +228,9 @@ def generate_clinical_details_table(conditions, encounters, medication_administr
 
     # Iterate through each medication administration and collect the necessary details
     for medication_administration in medication_administrations:
-        medication_administration_name = ''
-        medication_json = medication_administration.as_json() if callable(medication_administration.as_json) else medication_administration
-        medication_administration = json.loads(medication_json) if isinstance(medication_json, str) else medication_json
-
-        if 'medicationCodeableConcept' in medication_administration and medication_administration['medicationCodeableConcept']:
-            med_codeable_concept = medication_administration['medicationCodeableConcept']
-            if 'text' in med_codeable_concept:
-                medication_administration_name = med_codeable_concept['text']
-            elif 'coding' in med_codeable_concept:
-                for coding in med_codeable_concept['coding']:
-                    if 'display' in coding:
-                        medication_administration_name = coding['display']
-                        break
-        elif 'medicationReference' in medication_administration and medication_administration['medicationReference']:
-            medication_administration_name = medication_administration['medicationReference'].get('display', '')
-        else:
-            raise Exception("A medication resource has no human-readable 'medication[x]' element")
-
-        medication_administration_status = medication_administration.get('status', 'Unknown')
-
         medication_administrations_list.append({
-            'medication_administration_name': medication_administration_name,
-            'medication_administration_status': medication_administration_status,
+            'medication_administration_name': medication_administration.name,
+            'medication_administration_status': medication_administration.status,
         })
 
     # Sort medication administrations by status
@@ -226,41 +263,6 @@ def generate_clinical_details_table(conditions, encounters, medication_administr
 
     return conditions_table, encounters_table, medication_administrations_table
 
-def generate_prompt(sex, date_of_birth, health_conditions, encounters, medication_administrations, current_dt, combined_environmental_data):
-    return f""""
-    -------------------------------
-    Prompt Context
-
-    You have been approached by a healthcare professional seeking consultation on how to mitigate the health risks or treat the health complications 
-    associated with climate-related events, such as heat waves or forest fires. Your role as the AI specialist is to provide a consultation based on 
-    the specific characteristics and surrounding environment of the patient, like their demographics, health conditions, medications, encounter history, Universal AQI, 
-    temperature, and apparent temperature.
-    -------------------------------
-    Patient Details
-
-    Sex: {sex}
-    Date of Birth: {date_of_birth}
-    Health Conditions: {health_conditions}
-    Encounters: {encounters}
-    Medication Administrations: {medication_administrations}
-
-    Here is the past, present, and forecasted environmental data (in a tabular format) for the patient's primary address. Its columns include time, 
-    universal air quality index measurements (UAQI), temperature (Fahrenheit), and apparent temperature (Fahrenheit). Right now, The current datetime is {current_dt}.
-    Please note that the UAQI data and temperature data may not perfectly overlap in time, as they are collected from different sources. NaN values at the 
-    beginning and end of the time range should not be considered as missing data, but rather as the absence of data.
-
-    Furthermore, here is the scale for the Universal AQI (UAQI) values:
-    100 - 80 = "Excellent air quality"
-    79 - 60	= "Good air quality"
-    59 - 40	= "Moderate air quality"
-    39 - 20	= "Low air quality"
-    19 - 0 = "Poor air quality"
-    
-    {combined_environmental_data}
-
-    -------------------------------
-    """
-
 def generate_iframe(address):
     url_escaped_address = urllib.parse.quote(address, safe='') # URL escape the address for embedding a Maps iFrame
     return f"https://www.google.com/maps/embed/v1/place?key={os.getenv('GOOGLE_MAPS_API_KEY')}&q={url_escaped_address}&zoom=11&maptype=satellite"
@@ -345,15 +347,236 @@ def get_patient_demographics(patient):
     """
     return (name, sex, birthday, address)
 
-def fetch_all_resources(resource_class, smart):
-    resources = []
-    next_url = resource_class.where(struct={'patient': smart.patient_id}).perform(smart.server)
-    
-    while next_url:
-        if next_url.entry:
-            resources.extend(entry.resource for entry in next_url.entry)
-        
-        next_link = next((link.url for link in next_url.link if link.relation == 'next'), None)
-        next_url = Bundle.read_from(next_link, smart.server) if next_link else None
-
-    return resources
+def get_address_geolocation(patient):
+    # Return (latitude, longitude) from the standard FHIR geolocation extension on the patient's address, if present
+    if not patient.address or len(patient.address) != 1:
+        return None
+    for extension in patient.address[0].extension or []:
+        if extension.url == 'http://hl7.org/fhir/StructureDefinition/geolocation':
+            coordinates = {sub_extension.url: sub_extension.valueDecimal for sub_extension in extension.extension or []}
+            if coordinates.get('latitude') is not None and coordinates.get('longitude') is not None:
+                return float(coordinates['latitude']), float(coordinates['longitude'])
+    return None
+
+def build_search_struct(resource_class, patient_id, profile=None):
+    # Search parameters for the patient's resources, narrowed by the resource type's search profile
+    struct = {'patient': patient_id}
+    if profile is None and FHIR_SEARCH_PROFILES_ENABLED:
+        profile = FHIR_SEARCH_PROFILES.get(resource_class.resource_type)
+    if profile:
+        struct.update(profile.get('params', {}))
+        if profile.get('lookback_years'):
+            start = date.today() - timedelta(days=round(365.25 * float(profile['lookback_years'])))
+            struct[profile['date_param']] = f"ge{start.isoformat()}"
+    return struct
+
+def fetch_records(resource_class, smart):
+    # The patient's resources of the given type as compact records (see records.py), read as the search's pages arrive
+    with span('fhir_fetch_all', resource_class.resource_type):
+        return [RECORD_TYPES[resource_class.resource_type].from_json(resource) for resource in iter_all_resources(resource_class, smart)]
+
+def read_patient(smart):
+    with span('fhir_read', 'Patient'):
+        return Patient.read(rem_id=smart.patient_id, server=smart.server)
+
+def iter_all_resources(resource_class, smart, profile=None, max_buffered=FHIR_MAX_BUFFERED_RESOURCES):
+    # Yield the JSON of the patient's resources of the given type as the search's pages arrive
+    with span('fhir_page', resource_class.resource_type):
+        bundle = smart.server.request_json(resource_class.where(struct=build_search_struct(resource_class, smart.patient_id, profile)).construct())
+    return iter_bundle_pages(bundle, smart.server, max_buffered, detail=resource_class.resource_type)
+
+def iter_bundle_pages(bundle, server, max_buffered=FHIR_MAX_BUFFERED_RESOURCES, detail=None):
+    """
+    Yield the resource JSON of a searchset Bundle (as a dict), following its 'next' links.
+    Pages are read as plain JSON rather than fhirclient models. Once iteration starts, a
+    background thread requests the next page as soon as the current one has been handed
+    over, so the network round trip overlaps with the consumer's processing, while holding
+    at most 'max_buffered' resources the consumer hasn't taken yet. The thread stops when
+    the pages run out or the generator is closed (or garbage collected). Each page request
+    is timed as a 'fhir_page' span, with 'detail' (e.g. the resource type) as its description.
+    """
+    buffer = queue.Queue(maxsize=max_buffered)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Block while the buffer is full, unless the consumer has gone away
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def prefetch():
+        try:
+            page = bundle
+            while page:
+                for entry in page.get('entry', []):
+                    if 'resource' in entry and not put(entry['resource']):
+                        return
+                next_link = next((link['url'] for link in page.get('link', []) if link.get('relation') == 'next'), None)
+                if not next_link:
+                    break
+                with span('fhir_page', detail):
+                    page = server.request_json(next_link)
+            put(done)
+        except Exception as e:
+            put(e)
+
+    def consume():
+        # The prefetch thread starts on the first next(), so a generator that is never iterated leaves no thread behind
+        threading.Thread(target=in_current_context(prefetch), name='fhir-prefetch', daemon=True).start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+
+    return consume()
+
+def run_concurrently(executor, tasks, timeout):
+    """
+    Submit every callable in the 'tasks' dict to the executor and wait until all
+    of them finish or the deadline (in seconds) passes. Returns a dict of results
+    and a dict of errors, both keyed like 'tasks'. Tasks that missed the deadline
+    are cancelled and reported as a TimeoutError. Tasks run in a copy of the caller's
+    context, so their timing spans count towards the caller's request.
+    """
+    futures = {key: executor.submit(in_current_context(task)) for key, task in tasks.items()}
+    wait(futures.values(), timeout=timeout)
+
+    results, errors = {}, {}
+    for key, future in futures.items():
+        if not future.done():
+            future.cancel()
+            errors[key] = TimeoutError(f"'{key}' did not finish within {timeout} seconds")
+        elif future.exception() is not None:
+            errors[key] = future.exception()
+        else:
+            results[key] = future.result()
+    return results, errors
+
+def fetch_patient_records(smart, executor=None):
+    """
+    Read the launched Patient and search its Conditions, Medication Administrations
+    and Encounters concurrently, so the total wait is set by the slowest read.
+    Each search is consumed as its pages arrive and each resource's JSON is reduced to
+    a compact record (see records.py), so full resources are never all held in memory.
+    The Patient is required; a resource type that fails or misses the deadline is
+    returned as an empty list and reported in 'errors' so the page can still render.
+    The reads run on 'executor', by default the shared fhir_executor.
+    Depending on FHIR_FETCH_MODE, everything is fetched in one round trip instead.
+    """
+    if FHIR_FETCH_MODE != 'search':
+        capabilities = get_server_capabilities(smart) if FHIR_FETCH_MODE == 'auto' else {FHIR_FETCH_MODE: True}
+        if capabilities.get('batch'):
+            return fetch_patient_records_batch(smart)
+        if capabilities.get('everything'):
+            return fetch_patient_records_everything(smart)
+
+    tasks = {
+        'Patient': lambda: read_patient(smart),
+        'Condition': lambda: fetch_records(Condition, smart),
+        'MedicationAdministration': lambda: fetch_records(MedicationAdministration, smart),
+        'Encounter': lambda: fetch_records(Encounter, smart),
+    }
+    results, errors = run_concurrently(executor or fhir_executor, tasks, timeout=float(os.getenv('FHIR_FETCH_TIMEOUT', 20)))
+    if 'Patient' in errors:
+        raise errors['Patient']
+
+    return (
+        results['Patient'],
+        results.get('Condition', []),
+        results.get('MedicationAdministration', []),
+        results.get('Encounter', []),
+        errors
+    )
+
+def get_server_capabilities(smart):
+    """
+    Return which of the batch interaction and the Patient $everything operation the FHIR
+    server declares in its CapabilityStatement. The statement is read once per server.
+    """
+    base_uri = smart.server.base_uri
+    if base_uri not in server_capabilities:
+        # Read 'metadata' directly: fhirclient's get_capability() would also reset the session's authorization
+        with span('fhir_metadata'):
+            capability_statement = smart.server.request_json('metadata')
+        batch, everything = False, False
+        for rest in capability_statement.get('rest', []):
+            batch = batch or any(interaction.get('code') == 'batch' for interaction in rest.get('interaction', []))
+            for resource in rest.get('resource', []):
+                if resource.get('type') == 'Patient':
+                    everything = everything or any(
+                        operation.get('name') in ['everything', '$everything'] or operation.get('definition', '').endswith('Patient-everything')
+                        for operation in resource.get('operation', [])
+                    )
+        server_capabilities[base_uri] = {'batch': batch, 'everything': everything}
+    return server_capabilities[base_uri]
+
+def fetch_patient_records_batch(smart):
+    """
+    Read the Patient and search its Conditions, Medication Administrations and Encounters
+    in a single FHIR batch request, then follow any 'next' links of the searches.
+    Returns the same tuple as fetch_patient_records.
+    """
+    searches = {resource_class.resource_type: resource_class for resource_class in [Condition, MedicationAdministration, Encounter]}
+    entries = [{'request': {'method': 'GET', 'url': f"Patient/{smart.patient_id}"}}]
+    for resource_class in searches.values():
+        entries.append({'request': {'method': 'GET', 'url': resource_class.where(struct=build_search_struct(resource_class, smart.patient_id)).construct()}})
+    with span('fhir_batch'):
+        response = smart.server.post_json('', {'resourceType': 'Bundle', 'type': 'batch', 'entry': entries})
+
+    results, errors = {}, {}
+    for resource_type, entry in zip(['Patient', *searches], response.json().get('entry', [])):
+        status = entry.get('response', {}).get('status', '')
+        if not status.startswith('2') or 'resource' not in entry:
+            errors[resource_type] = Exception(f"The batch {resource_type} request returned '{status}'")
+        elif resource_type == 'Patient':
+            results[resource_type] = Patient(entry['resource'])
+        else:
+            try:
+                results[resource_type] = [RECORD_TYPES[resource_type].from_json(resource) for resource in iter_bundle_pages(entry['resource'], smart.server, detail=resource_type)]
+            except Exception as e:
+                errors[resource_type] = e
+    if 'Patient' not in results:
+        raise errors.get('Patient', Exception("The batch response has no Patient entry"))
+
+    for resource_type in searches:
+        if resource_type not in results and resource_type not in errors:
+            errors[resource_type] = Exception(f"The batch response has no {resource_type} entry")
+    return (
+        results['Patient'],
+        results.get('Condition', []),
+        results.get('MedicationAdministration', []),
+        results.get('Encounter', []),
+        errors
+    )
+
+def fetch_patient_records_everything(smart):
+    """
+    Retrieve the Patient and its Conditions, Medication Administrations and Encounters with
+    the Patient $everything operation, limited to those types. Returns the same tuple as
+    fetch_patient_records.
+    """
+    resource_types = ['Patient', 'Condition', 'MedicationAdministration', 'Encounter']
+    with span('fhir_everything'):
+        bundle = smart.server.request_json(f"Patient/{smart.patient_id}/$everything?_type={','.join(resource_types)}&_count={FHIR_PAGE_SIZE}")
+    results = {resource_type: [] for resource_type in resource_types}
+    for resource in iter_bundle_pages(bundle, smart.server, detail='$everything'):
+        if resource.get('resourceType') == 'Patient':
+            results['Patient'].append(resource)
+        elif resource.get('resourceType') in RECORD_TYPES:
+            results[resource['resourceType']].append(RECORD_TYPES[resource['resourceType']].from_json(resource))
+
+    patient = next((patient for patient in results['Patient'] if patient.get('id') == smart.patient_id), None)
+    if patient is None:
+        raise Exception("The $everything response has no Patient resource")
+    return Patient(patient), results['Condition'], results['MedicationAdministration'], results['Encounter'], {}